@@ -1,18 +1,176 @@
 from ..utils.config_secrets import Secrets
-from sqlmodel import SQLModel, create_engine, Session
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import (
+    AsyncConnection,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _async_database_url(url: str) -> str:
+    # The async engine needs the asyncpg driver instead of psycopg2
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return "postgresql+asyncpg://" + url[len(prefix) :]
+    return url
+
 
 # PostgreSQL database URL
-DATABASE_URL = Secrets.POSTGRES.POSTGRES_URL
+DATABASE_URL = _async_database_url(Secrets.POSTGRES.POSTGRES_URL)
+
+# Create an async database engine with a bounded connection pool
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=Secrets.POSTGRES.POSTGRES_POOL_SIZE,
+    max_overflow=Secrets.POSTGRES.POSTGRES_MAX_OVERFLOW,
+    pool_timeout=Secrets.POSTGRES.POSTGRES_POOL_TIMEOUT,
+    pool_recycle=Secrets.POSTGRES.POSTGRES_POOL_RECYCLE,
+    pool_pre_ping=Secrets.POSTGRES.POSTGRES_POOL_PRE_PING,
+)
 
-# Create a database engine
-engine = create_engine(DATABASE_URL)
+async_session_maker = async_sessionmaker(
+    engine, class_=AsyncSession, expire_on_commit=False
+)
 
 
 # Create a session maker
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with async_session_maker() as session:
         yield session
 
 
+async def _upgrade_media_metadata(conn: AsyncConnection):
+    """
+    Brings a mediametadata table created by an older version up to date.
+    create_all() doesn't alter existing tables, so this runs on every start
+    and only changes what is missing.
+    """
+    narrow_columns = (
+        (
+            await conn.execute(
+                text(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = 'mediametadata' "
+                    "AND column_name IN ('media_pk', 'user_id') AND data_type = 'integer'"
+                )
+            )
+        )
+        .scalars()
+        .all()
+    )
+    for column in narrow_columns:
+        # Instagram pks don't fit in 32 bits
+        logger.info(f"Widening mediametadata.{column} to BIGINT")
+        await conn.execute(
+            text(f"ALTER TABLE mediametadata ALTER COLUMN {column} TYPE BIGINT")
+        )
+
+    for column in (
+        "highlight_id VARCHAR",
+        "local_path VARCHAR",
+        "content_hash VARCHAR",
+        "download_attempts INTEGER NOT NULL DEFAULT 0",
+        "download_started_at TIMESTAMP WITH TIME ZONE",
+    ):
+        await conn.execute(
+            text(f"ALTER TABLE mediametadata ADD COLUMN IF NOT EXISTS {column}")
+        )
+    await conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_mediametadata_user_id "
+            "ON mediametadata (user_id)"
+        )
+    )
+    await conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_mediametadata_download_pending "
+            "ON mediametadata (id) WHERE local_path IS NULL"
+        )
+    )
+
+    unique_index = (
+        await conn.execute(text("SELECT to_regclass('uq_mediametadata_media_id_url')"))
+    ).scalar()
+    if unique_index is None:
+        # Duplicates stored before the constraint existed would block it
+        result = await conn.execute(
+            text(
+                "DELETE FROM mediametadata a USING mediametadata b "
+                "WHERE a.id > b.id AND a.media_id = b.media_id AND a.url = b.url"
+            )
+        )
+        logger.info(
+            f"Removed {result.rowcount} duplicate mediametadata rows, adding unique index"
+        )
+        await conn.execute(
+            text(
+                "CREATE UNIQUE INDEX uq_mediametadata_media_id_url "
+                "ON mediametadata (media_id, url)"
+            )
+        )
+
+
+async def _upgrade_media_scan_state(conn: AsyncConnection):
+    await conn.execute(
+        text(
+            "ALTER TABLE mediascanstate "
+            "ADD COLUMN IF NOT EXISTS lease_until TIMESTAMP WITH TIME ZONE"
+        )
+    )
+
+
+async def _upgrade_highlight_scrape_job(conn: AsyncConnection):
+    unique_index = (
+        await conn.execute(
+            text("SELECT to_regclass('uq_highlightscrapejob_active_username')")
+        )
+    ).scalar()
+    if unique_index is None:
+        # Duplicate active jobs created before the index existed would block it
+        result = await conn.execute(
+            text(
+                "UPDATE highlightscrapejob a SET status = 'failed', "
+                "error = 'Duplicate job', finished_at = now() "
+                "FROM highlightscrapejob b "
+                "WHERE a.id > b.id AND a.username = b.username "
+                "AND a.status IN ('queued', 'running') "
+                "AND b.status IN ('queued', 'running')"
+            )
+        )
+        logger.info(
+            f"Failed {result.rowcount} duplicate highlight scrape jobs, adding unique index"
+        )
+        await conn.execute(
+            text(
+                "CREATE UNIQUE INDEX uq_highlightscrapejob_active_username "
+                "ON highlightscrapejob (username) "
+                "WHERE status IN ('queued', 'running')"
+            )
+        )
+
+
+async def _upgrade_profile_stats_history(conn: AsyncConnection):
+    # Partial stats record the counts they have, the others are NULL
+    for column in ("reels_count", "highlights_count"):
+        await conn.execute(
+            text(f"ALTER TABLE profilestatshistory ALTER COLUMN {column} DROP NOT NULL")
+        )
+
+
 # Create all tables
-SQLModel.metadata.create_all(engine)
+async def init_db():
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await _upgrade_media_metadata(conn)
+        await _upgrade_media_scan_state(conn)
+        await _upgrade_highlight_scrape_job(conn)
+        await _upgrade_profile_stats_history(conn)
+
+
+async def close_db():
+    await engine.dispose()
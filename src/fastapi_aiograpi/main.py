@@ -5,9 +5,18 @@ from sentry_sdk.integrations.fastapi import FastApiIntegration
 from sentry_sdk.integrations.starlette import StarletteIntegration
 from sentry_sdk.integrations.asyncio import AsyncioIntegration
 from .utils.config_secrets import Secrets
-from .database.postgresql_handler import get_session
-from .utils.session_manager import SessionStore
+from .database.postgresql_handler import async_session_maker, close_db, init_db
+from .utils.session_manager import SessionStore, user_cache
+from .utils.client_pool import client_pool
+from .utils.highlight_jobs import highlight_jobs
+from .utils.media_downloader import media_downloader
+from .utils.password_hasher import password_hasher
+from .utils.proxy_manager import proxy_manager
+from .utils.proxy_scheduler import proxy_scheduler
+from .utils.rate_limiter import rate_limiter
 from .routes.auth import auth
+from .routes.media import media
+from .routes.metrics import metrics
 from .routes.profiles import profile_stats, highlights
 import logging
 
@@ -48,6 +57,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
     return JSONResponse(
         status_code=exc.status_code,
         content={"detail": exc.detail},
+        headers=exc.headers,
     )
 
 
@@ -63,13 +73,33 @@ async def general_exception_handler(request: Request, exc: Exception):
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(profile_stats.router, prefix="/profiles", tags=["profiles"])
 app.include_router(highlights.router, prefix="/highlights", tags=["highlights"])
+app.include_router(media.router, prefix="/media", tags=["media"])
+app.include_router(metrics.router, prefix="/metrics", tags=["metrics"])
 
 
 @app.on_event("startup")
 async def startup_event():
-    with next(get_session()) as session:
+    await init_db()
+    async with async_session_maker() as session:
         session_store = SessionStore(session)
-        session_store.load_sessions()
+        await session_store.load_sessions()
+    proxy_scheduler.register_accounts(user_cache.proxies())
+    proxy_manager.start_monitor()
+    rate_limiter.start()
+    highlight_jobs.start()
+    if Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_ENABLED:
+        media_downloader.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await highlight_jobs.aclose()
+    await media_downloader.aclose()
+    await client_pool.close()
+    password_hasher.shutdown()
+    await proxy_manager.aclose()
+    await rate_limiter.aclose()
+    await close_db()
 
 
 @app.get("/")
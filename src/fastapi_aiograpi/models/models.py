@@ -1,5 +1,7 @@
+from datetime import datetime, timezone
 from typing import Optional, List
 from pydantic import BaseModel
+from sqlalchemy import JSON, BigInteger, DateTime, Index, UniqueConstraint, text
 from sqlmodel import SQLModel, Field
 
 
@@ -26,10 +28,49 @@ class HighlightMediaResponse(BaseModel):
 class ProfileStats(BaseModel):
     username: str
     posts_count: int
-    reels_count: int
-    highlights_count: int
+    reels_count: Optional[int] = None
+    highlights_count: Optional[int] = None
     follower_count: int
     following_count: int
+    partial: bool = False
+
+
+class ProfileStatsPoint(BaseModel):
+    ts: datetime
+    posts_count: int
+    reels_count: Optional[int]
+    highlights_count: Optional[int]
+    follower_count: int
+    following_count: int
+
+
+class ProfileStatsHistoryResponse(BaseModel):
+    username: str
+    user_pk: int
+    bucket: Optional[str]
+    agg: str
+    points: List[ProfileStatsPoint]
+
+
+class HighlightJobStatus(BaseModel):
+    id: int
+    username: str
+    status: str
+    attempts: int
+    highlights_total: Optional[int]
+    highlights_done: int
+    items_stored: int
+    error: Optional[str]
+    created_at: datetime
+    updated_at: datetime
+    finished_at: Optional[datetime]
+
+
+class ProfileStatsBatchRequest(BaseModel):
+    account: str
+    password: str
+    usernames: List[str]
+    max_age: Optional[int] = None
 
 
 class HighlightMedia(BaseModel):
@@ -46,14 +87,156 @@ class User(SQLModel, table=True):
 
 
 class MediaMetadata(SQLModel, table=True):
+    # Also serves lookups by media_id, since it leads the index
+    __table_args__ = (
+        UniqueConstraint("media_id", "url", name="uq_mediametadata_media_id_url"),
+        # Rows still waiting for the media downloader
+        Index(
+            "ix_mediametadata_download_pending",
+            "id",
+            postgresql_where=text("local_path IS NULL"),
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     media_id: str
-    media_pk: int
+    media_pk: int = Field(sa_type=BigInteger)
+    highlight_id: Optional[str] = None
     url: str
     media_type: int
     product_type: str
-    user_id: int
+    user_id: int = Field(index=True, sa_type=BigInteger)
     username: str
     caption_text: Optional[str]
     like_count: Optional[int]
     comment_count: Optional[int]
+    local_path: Optional[str] = None
+    content_hash: Optional[str] = None
+    download_attempts: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
+    download_started_at: Optional[datetime] = Field(
+        default=None, sa_type=DateTime(timezone=True)
+    )
+
+
+class MediaPage(BaseModel):
+    items: List[MediaMetadata]
+    next_after: Optional[int]
+
+
+class UsernamePk(SQLModel, table=True):
+    username: str = Field(primary_key=True)
+    user_pk: int = Field(sa_type=BigInteger)
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+
+
+class RateLimitCounter(SQLModel, table=True):
+    key: str = Field(primary_key=True)
+    window_index: int = Field(primary_key=True, sa_type=BigInteger)
+    count: int = 0
+
+
+class ProfileStatsSnapshot(SQLModel, table=True):
+    username: str = Field(primary_key=True)
+    payload: dict = Field(sa_type=JSON)
+    fetched_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+
+
+class ProfileStatsHistory(SQLModel, table=True):
+    # The primary key index also serves range queries per user
+    user_pk: int = Field(
+        primary_key=True, sa_type=BigInteger, sa_column_kwargs={"autoincrement": False}
+    )
+    ts: datetime = Field(primary_key=True, sa_type=DateTime(timezone=True))
+    posts_count: int
+    # None when the count wasn't complete at the time
+    reels_count: Optional[int] = None
+    highlights_count: Optional[int] = None
+    follower_count: int
+    following_count: int
+
+
+class MediaScanState(SQLModel, table=True):
+    user_id: int = Field(
+        primary_key=True, sa_type=BigInteger, sa_column_kwargs={"autoincrement": False}
+    )
+    newest_pk: Optional[int] = Field(default=None, sa_type=BigInteger)
+    backfill_cursor: Optional[str] = None
+    complete: bool = False
+    scanned_count: int = 0
+    reels_count: int = 0
+    # Set while a scan is running, so concurrent scans of a user skip it
+    lease_until: Optional[datetime] = Field(
+        default=None, sa_type=DateTime(timezone=True)
+    )
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+
+
+class HighlightSnapshot(SQLModel, table=True):
+    id: str = Field(primary_key=True)
+    username: str
+    user_id: int = Field(sa_type=BigInteger)
+    highlights: list = Field(sa_type=JSON)
+    pages: dict = Field(default_factory=dict, sa_type=JSON)
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+
+
+class HighlightSyncState(SQLModel, table=True):
+    user_id: int = Field(
+        primary_key=True, sa_type=BigInteger, sa_column_kwargs={"autoincrement": False}
+    )
+    username: str
+    # Highlight pk -> {"media_count": ..., "latest_reel_media": ...} as of the
+    # last time its items were stored
+    highlights: dict = Field(default_factory=dict, sa_type=JSON)
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+
+
+class HighlightScrapeJob(SQLModel, table=True):
+    # One active job per user
+    __table_args__ = (
+        Index(
+            "uq_highlightscrapejob_active_username",
+            "username",
+            unique=True,
+            postgresql_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    username: str = Field(index=True)
+    status: str = Field(default="queued", index=True)
+    attempts: int = 0
+    highlights_total: Optional[int] = None
+    highlights_done: int = 0
+    items_stored: int = 0
+    error: Optional[str] = None
+    run_after: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+    created_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+    updated_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        sa_type=DateTime(timezone=True),
+    )
+    finished_at: Optional[datetime] = Field(
+        default=None, sa_type=DateTime(timezone=True)
+    )
@@ -1,2 +1,4 @@
 from . import auth  # noqa
+from . import media  # noqa
+from . import metrics  # noqa
 from . import profiles  # noqa
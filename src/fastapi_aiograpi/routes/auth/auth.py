@@ -11,7 +11,10 @@ from aiograpi.exceptions import (
 )
 import logging
 from ...utils.rate_limiter import rate_limiter
+from ...utils.resilience import call_upstream
 from ...utils.dependencies import get_client
+from ...utils.client_pool import client_pool
+from ...utils.session_validity import session_validity
 from ...database.postgresql_handler import get_session
 from ...utils.session_manager import SessionStore
 import sentry_sdk
@@ -32,8 +35,8 @@ async def login(
     """
     session_store = SessionStore(session)
     try:
-        rate_limiter.check_rate_limit(username)
-        session_data = session_store.get_session(username)
+        rate_limiter.check_rate_limit(username, route="login")
+        session_data = await session_store.get_session(username)
 
         login_via_session = False
         login_via_pw = False
@@ -44,10 +47,16 @@ async def login(
                 await client.login(username, request.password)
 
                 try:
-                    await client.get_timeline_feed()  # Check if session is valid
+                    if not session_validity.is_valid(username):
+                        # Check if session is valid
+                        await call_upstream(
+                            client.get_timeline_feed, username, client.proxy
+                        )
+                        session_validity.mark_valid(username)
                     login_via_session = True
                     logger.info(f"Logged in using session for user {username}")
                 except LoginRequired:
+                    session_validity.invalidate(username)
                     logger.info(
                         f"Session is invalid for user {username}, logging in with username and password"
                     )
@@ -58,6 +67,7 @@ async def login(
                     client.set_uuids(old_session["uuids"])
 
                     await client.login(username, request.password)
+                    session_validity.mark_valid(username)
                     login_via_pw = True
             except Exception as e:
                 logger.info(f"Couldn't login user {username} using session: {str(e)}")
@@ -66,7 +76,12 @@ async def login(
             logger.info(
                 f"Attempting to login via username and password for user {username}"
             )
-            if await client.login(username, request.password):
+            if await call_upstream(
+                lambda: client.login(username, request.password),
+                username,
+                client.proxy,
+            ):
+                session_validity.mark_valid(username)
                 login_via_pw = True
 
         if not login_via_pw and not login_via_session:
@@ -75,7 +90,7 @@ async def login(
             )
 
         # Save the session
-        session_store.save_session(
+        await session_store.save_session(
             username, client.get_settings(), client.proxy, request.password
         )
         sentry_sdk.add_breadcrumb(
@@ -87,6 +102,8 @@ async def login(
             success=True, message="Login successful", session_id=client.sessionid
         )
 
+    except HTTPException:
+        raise
     except ConnectProxyError as e:
         logger.exception(f"Proxy connection error: {e}")
         sentry_sdk.capture_exception(e)
@@ -102,6 +119,8 @@ async def login(
         PleaseWaitFewMinutes,
     ) as e:
         logger.exception(f"Login error: {e}")
+        if isinstance(e, LoginRequired):
+            session_validity.invalidate(username)
         sentry_sdk.capture_exception(e)
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
@@ -123,14 +142,20 @@ async def logout(
     """
     session_store = SessionStore(session)
     try:
-        rate_limiter.check_rate_limit(username)
-        session_store.save_session(username, {}, client.proxy)  # Clear the session
+        rate_limiter.check_rate_limit(username, route="logout")
+        await session_store.save_session(
+            username, {}, client.proxy
+        )  # Clear the session
+        await client_pool.evict(username)  # Don't hand out logged-in clients
+        session_validity.invalidate(username)
         sentry_sdk.add_breadcrumb(
             category="auth",
             message="Logout successful",
             data={"username": username, "proxy": client.proxy},
         )
         return {"success": True, "message": "Logged out successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.exception(f"Unexpected error during logout: {e}")
         sentry_sdk.capture_exception(e)
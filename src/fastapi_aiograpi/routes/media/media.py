@@ -0,0 +1,215 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, List, Literal, Optional
+from fastapi import APIRouter, HTTPException, Depends, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy import BigInteger, DateTime, Integer
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+import logging
+import sentry_sdk
+from ...utils.config_secrets import Secrets
+from ...utils.session_manager import SessionStore
+from ...models.models import MediaMetadata, MediaPage
+from ...database.postgresql_handler import async_session_maker, get_session
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet export is optional
+    pa = None
+    pq = None
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+COLUMNS = list(MediaMetadata.__table__.columns)
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+async def _verify(username: str, password: str, session: AsyncSession):
+    if not await SessionStore(session).verify_password(username, password):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid credentials. Please log in via /auth/login endpoint.",
+        )
+
+
+def _filter(
+    statement,
+    username: str,
+    user_id: Optional[int],
+    product_type: Optional[str],
+    after: Optional[int],
+):
+    statement = statement.where(MediaMetadata.username == username.lower())
+    if user_id is not None:
+        statement = statement.where(MediaMetadata.user_id == user_id)
+    if product_type is not None:
+        statement = statement.where(MediaMetadata.product_type == product_type)
+    if after is not None:
+        statement = statement.where(MediaMetadata.id > after)
+    # Keyset pagination: rows come in id order and "after" resumes past the
+    # last id seen, without OFFSET scans
+    return statement.order_by(MediaMetadata.id)
+
+
+class _ChunkSink(io.RawIOBase):
+    """
+    File object the Parquet writer writes to, drained after every row group.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet_schema():
+    def arrow_type(column):
+        if isinstance(column.type, (Integer, BigInteger)):
+            return pa.int64()
+        if isinstance(column.type, DateTime):
+            return pa.timestamp("us", tz="UTC")
+        return pa.string()
+
+    return pa.schema([(column.name, arrow_type(column)) for column in COLUMNS])
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't serialize {type(value).__name__}")
+
+
+async def _export_rows(statement, fmt: str) -> AsyncIterator[bytes]:
+    """
+    Streams the rows from a server-side cursor, MEDIA_EXPORT_BATCH_SIZE rows at
+    a time, so memory use doesn't grow with the size of the export. Runs on its
+    own DB session, since the request's dependencies are torn down before the
+    body is streamed.
+    """
+    batch_size = Secrets.MEDIA_EXPORT.MEDIA_EXPORT_BATCH_SIZE
+    names = [column.name for column in COLUMNS]
+    writer = None
+    sink = None
+    if fmt == "csv":
+        yield _csv_lines([names])
+    elif fmt == "parquet":
+        schema = _parquet_schema()
+        sink = _ChunkSink()
+        writer = pq.ParquetWriter(sink, schema)
+
+    exported = 0
+    try:
+        async with async_session_maker() as session:
+            result = await session.stream(
+                statement.execution_options(yield_per=batch_size)
+            )
+            async for rows in result.mappings().partitions():
+                exported += len(rows)
+                if fmt == "csv":
+                    yield _csv_lines([[row[name] for name in names] for row in rows])
+                elif fmt == "ndjson":
+                    yield "".join(
+                        json.dumps(dict(row), default=_json_default) + "\n"
+                        for row in rows
+                    ).encode()
+                else:
+                    # One row group per batch
+                    writer.write_table(
+                        pa.Table.from_pylist([dict(row) for row in rows], schema=schema)
+                    )
+                    yield sink.drain()
+        if writer is not None:
+            writer.close()
+            yield sink.drain()
+        logger.info(f"Exported {exported} media rows as {fmt}")
+    except Exception as e:
+        # The status line is already sent; cutting the stream short tells the
+        # client the export is incomplete
+        logger.exception(f"Media export failed after {exported} rows: {e}")
+        sentry_sdk.capture_exception(e)
+        raise
+
+
+def _csv_lines(rows: List[list]) -> bytes:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+@router.get("/", response_model=MediaPage)
+async def list_media(
+    username: str,
+    password: str,
+    user_id: Optional[int] = Query(None),
+    product_type: Optional[str] = Query(None),
+    after: Optional[int] = Query(None, description="Return rows with a larger id"),
+    limit: int = Query(100, ge=1, le=1000),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Returns the account's stored media in id order. Pass next_after back as
+    after for the next page.
+    """
+    await _verify(username, password, session)
+    statement = _filter(
+        select(MediaMetadata), username, user_id, product_type, after
+    ).limit(limit)
+    items = list((await session.exec(statement)).all())
+    next_after = items[-1].id if len(items) == limit else None
+    return MediaPage(items=items, next_after=next_after)
+
+
+@router.get("/export")
+async def export_media(
+    username: str,
+    password: str,
+    fmt: Literal["csv", "ndjson", "parquet"] = Query("ndjson", alias="format"),
+    user_id: Optional[int] = Query(None),
+    product_type: Optional[str] = Query(None),
+    after: Optional[int] = Query(None, description="Export rows with a larger id"),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Streams all of the account's stored media matching the filters, in id
+    order, as CSV, NDJSON or Parquet. An interrupted export can be resumed by
+    passing the last exported id as after.
+    """
+    if fmt == "parquet" and pa is None:
+        raise HTTPException(
+            status_code=501,
+            detail="Parquet export requires pyarrow to be installed.",
+        )
+    await _verify(username, password, session)
+    statement = _filter(select(*COLUMNS), username, user_id, product_type, after)
+    return StreamingResponse(
+        _export_rows(statement, fmt),
+        media_type=MEDIA_TYPES[fmt],
+        headers={
+            "Content-Disposition": f'attachment; filename="media.{fmt}"',
+            "X-Accel-Buffering": "no",
+        },
+    )
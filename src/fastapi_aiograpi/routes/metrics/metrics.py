@@ -0,0 +1,40 @@
+from fastapi import APIRouter
+from ...utils.client_pool import client_pool
+from ...utils.highlight_jobs import highlight_jobs
+from ...utils.highlight_snapshots import highlight_snapshots
+from ...utils.highlight_sync import highlight_sync
+from ...utils.media_downloader import media_downloader
+from ...utils.media_scanner import media_scanner
+from ...utils.password_hasher import password_hasher
+from ...utils.profile_stats_cache import profile_stats_cache
+from ...utils.profile_stats_history import profile_stats_history
+from ...utils.proxy_manager import proxy_manager
+from ...utils.proxy_scheduler import proxy_scheduler
+from ...utils.resilience import circuit_breaker
+from ...utils.single_flight import single_flight
+from ...utils.user_resolver import user_resolver
+
+router = APIRouter()
+
+
+@router.get("/")
+async def get_metrics():
+    """
+    Returns in-process counters for the client pool, caches and worker pools.
+    """
+    return {
+        "circuit_breaker": circuit_breaker.stats(),
+        "client_pool": client_pool.stats(),
+        "highlight_jobs": highlight_jobs.stats(),
+        "highlight_snapshots": highlight_snapshots.stats(),
+        "highlight_sync": highlight_sync.stats(),
+        "media_downloader": media_downloader.stats(),
+        "media_scanner": media_scanner.stats(),
+        "password_hasher": password_hasher.stats(),
+        "profile_stats_cache": profile_stats_cache.stats(),
+        "profile_stats_history": profile_stats_history.stats(),
+        "proxies": proxy_manager.stats(),
+        "proxy_load": proxy_scheduler.stats(),
+        "single_flight": single_flight.stats(),
+        "user_resolver": user_resolver.stats(),
+    }
@@ -1,82 +1,234 @@
+import asyncio
+import json
+from typing import List, Literal, Optional
 from fastapi import APIRouter, HTTPException, Depends, Query, Path
+from fastapi.responses import StreamingResponse
 from aiograpi import Client
 import logging
 import sentry_sdk
-from ...utils.rate_limiter import rate_limiter
-from ...utils.dependencies import get_client
-from ...models.models import HighlightMedia, HighlightMediaResponse, MediaMetadata
+from ...utils.config_secrets import Secrets
+from ...utils.dependencies import leased_client
+from ...utils.highlight_jobs import highlight_jobs
+from ...utils.highlight_scraper import (
+    fetch_highlight_list,
+    rate_limit_delay,
+    sync_highlight,
+)
+from ...utils.highlight_snapshots import highlight_snapshots
+from ...utils.highlight_sync import highlight_sync
+from ...utils.session_manager import SessionStore
+from ...utils.session_validity import session_validity
+from ...utils.user_resolver import user_resolver
+from ...models.models import (
+    HighlightJobStatus,
+    HighlightMedia,
+    HighlightMediaResponse,
+    HighlightSnapshot,
+)
 from aiograpi.exceptions import ClientError, ClientLoginRequired
-from sqlmodel import Session, select
-from ...database.postgresql_handler import get_session
-
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ...database.postgresql_handler import async_session_maker, get_session
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
+async def build_page(
+    client: Client,
+    snapshot: HighlightSnapshot,
+    offset: int,
+    limit: int,
+    session: AsyncSession,
+) -> List[HighlightMedia]:
+    state = await highlight_sync.load(
+        snapshot.user_id, snapshot.username, snapshot.highlights, session
+    )
+    page = []
+    for highlight in snapshot.highlights[offset : offset + limit]:
+        page.extend(
+            await sync_highlight(
+                client,
+                snapshot.username,
+                snapshot.user_id,
+                highlight,
+                state,
+                session,
+            )
+        )
+    return page
+
+
+def _format_event(fmt: str, event: str, data: str) -> str:
+    if fmt == "sse":
+        return f"event: {event}\ndata: {data}\n\n"
+    if event == "error":
+        return f'{{"error": {data}}}\n'
+    return f"{data}\n"
+
+
+async def stream_highlight_media(
+    username: str,
+    password: str,
+    snapshot_id: Optional[str],
+    offset: int,
+    fmt: str,
+):
+    """
+    Yields each highlight's new media as soon as it is resolved, from offset to
+    the end of the snapshot. Runs on its own DB session and client lease, since
+    the request's dependencies are torn down before the body is streamed.
+    Stored items are committed every HIGHLIGHT_STREAM_BATCH_SIZE highlights.
+    """
+    batch_size = Secrets.HIGHLIGHT_SNAPSHOT.HIGHLIGHT_STREAM_BATCH_SIZE
+    async with async_session_maker() as session:
+        try:
+            snapshot = None
+            position = offset
+            while True:
+                delay = None
+                async with leased_client(username, password, session) as client:
+                    if snapshot is None:
+                        if snapshot_id is None:
+                            user_id = await user_resolver.resolve(
+                                client, username, session
+                            )
+                            highlights = await fetch_highlight_list(
+                                client, username, user_id
+                            )
+                            snapshot = await highlight_snapshots.create(
+                                username, user_id, highlights, session
+                            )
+                        else:
+                            snapshot = await highlight_snapshots.get(
+                                snapshot_id, session
+                            )
+                        state = await highlight_sync.load(
+                            snapshot.user_id,
+                            snapshot.username,
+                            snapshot.highlights,
+                            session,
+                        )
+                    pending = 0
+                    try:
+                        for highlight in snapshot.highlights[position:]:
+                            media = await sync_highlight(
+                                client,
+                                snapshot.username,
+                                snapshot.user_id,
+                                highlight,
+                                state,
+                                session,
+                            )
+                            position += 1
+                            pending += 1
+                            if pending >= batch_size:
+                                await session.commit()
+                                pending = 0
+                            for highlight_media in media:
+                                yield _format_event(
+                                    fmt, "highlight", highlight_media.model_dump_json()
+                                )
+                    except HTTPException as e:
+                        delay = rate_limit_delay(e)
+                        if delay is None:
+                            raise
+                if delay is None:
+                    break
+                # Wait out the per-highlight rate limit without holding the
+                # proxy slot or a DB connection, then carry on
+                await session.commit()
+                logger.info(
+                    f"Highlight stream for {username} rate limited, resuming in {delay}s"
+                )
+                await asyncio.sleep(delay)
+            await session.commit()
+            if fmt == "sse":
+                yield _format_event(fmt, "end", "{}")
+        except Exception as e:
+            # The status line is already sent, so errors go into the stream.
+            # Items already streamed stay stored.
+            try:
+                await session.commit()
+            except Exception:
+                await session.rollback()
+            if isinstance(e, HTTPException):
+                detail = e.detail
+            elif isinstance(e, ClientLoginRequired):
+                session_validity.invalidate(username)
+                detail = "Authentication required. Please log in."
+            else:
+                logger.exception(f"Error streaming highlight media for {username}: {e}")
+                sentry_sdk.capture_exception(e)
+                detail = "An error occurred while fetching highlight media."
+            yield _format_event(fmt, "error", json.dumps({"detail": detail}))
+
+
 @router.get("/{username}/highlight_media", response_model=HighlightMediaResponse)
 async def get_highlight_media(
+    password: str,
     username: str = Path(...),
-    client: Client = Depends(get_client),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_session),
     limit: int = Query(5, ge=1, le=20),
+    cursor: Optional[str] = Query(None),
+    stream: Optional[Literal["ndjson", "sse"]] = Query(None),
 ):
+    """
+    Returns the media of highlights not returned before, limit highlights per
+    page. Pass next_cursor back as cursor for the next page; pages come from a
+    snapshot of the highlight list taken on the first page.
+
+    With stream=ndjson or stream=sse, all remaining highlights are streamed
+    instead, one HighlightMedia per line or event as soon as it is resolved.
+    """
     try:
-        rate_limiter.check_rate_limit(username)
-        user_info = await client.user_info_by_username(username)
-        user_id = user_info.pk
-
-        # Fetch all grabbed highlights for this profile
-        statement = select(MediaMetadata).where(MediaMetadata.user_id == user_id)
-        stored_media_metadata = session.exec(statement).all()
-        stored_media_ids = {media.media_id for media in stored_media_metadata}
-
-        highlights = await client.user_highlights(user_id)
-        filtered_highlights = [
-            highlight
-            for highlight in highlights
-            if highlight.id not in stored_media_ids
-        ]
-
-        end_index = min(limit, len(filtered_highlights))
-
-        highlight_media = []
-        for highlight in filtered_highlights[:end_index]:
-            media_urls = []
-            for item in highlight.items:
-                if item.video_url:
-                    media_urls.append(item.video_url)
-                elif item.thumbnail_url:
-                    media_urls.append(item.thumbnail_url)
-
-                # Store media metadata in PostgreSQL
-                media_metadata = MediaMetadata(
-                    media_id=highlight.id,
-                    media_pk=highlight.pk,
-                    url=item.video_url or item.thumbnail_url,
-                    media_type=highlight.media_type,
-                    product_type=highlight.product_type,
-                    user_id=user_id,
-                    username=username,
-                    caption_text=highlight.caption_text,
-                    like_count=highlight.like_count,
-                    comment_count=highlight.comment_count,
-                )
-                session.add(media_metadata)
+        snapshot = None
+        offset = 0
+        page = None
+        if cursor:
+            snapshot_id, offset = highlight_snapshots.decode_cursor(cursor, username)
+            snapshot = await highlight_snapshots.get(snapshot_id, session)
+            if stream is None:
+                page = highlight_snapshots.get_page(snapshot, offset, limit)
 
-            highlight_media.append(
-                HighlightMedia(highlight_id=highlight.id, media_urls=media_urls)
+        if stream is not None:
+            return StreamingResponse(
+                stream_highlight_media(
+                    username,
+                    password,
+                    snapshot.id if snapshot else None,
+                    offset,
+                    stream,
+                ),
+                media_type=(
+                    "text/event-stream" if stream == "sse" else "application/x-ndjson"
+                ),
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
             )
 
-        next_cursor = str(end_index) if end_index < len(filtered_highlights) else None
+        if page is None:
+            async with leased_client(username, password, session) as client:
+                if snapshot is None:
+                    user_id = await user_resolver.resolve(client, username, session)
+                    highlights = await fetch_highlight_list(client, username, user_id)
+                    snapshot = await highlight_snapshots.create(
+                        username, user_id, highlights, session
+                    )
+                page = await build_page(client, snapshot, offset, limit, session)
+            await highlight_snapshots.save_page(snapshot, offset, limit, page, session)
 
-        session.commit()
+        next_offset = offset + limit
+        next_cursor = None
+        if next_offset < len(snapshot.highlights):
+            next_cursor = highlight_snapshots.encode_cursor(
+                snapshot.id, username, next_offset
+            )
 
-        return HighlightMediaResponse(
-            highlights=highlight_media, next_cursor=next_cursor
-        )
+        return HighlightMediaResponse(highlights=page, next_cursor=next_cursor)
+    except HTTPException:
+        raise
     except ClientLoginRequired:
         logger.error(f"Client not logged in for {username}")
+        session_validity.invalidate(username)
         raise HTTPException(
             status_code=401,
             detail="Authentication required. Please log in.",
@@ -94,3 +246,36 @@ async def get_highlight_media(
             status_code=500,
             detail=f"An error occurred while fetching highlight media: {str(e)}",
         )
+
+
+@router.post("/{username}/jobs", response_model=HighlightJobStatus, status_code=202)
+async def create_highlight_job(
+    password: str,
+    username: str = Path(...),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Queues a background scrape of all of the user's highlights, storing new
+    items like the highlight_media endpoint does. Returns the job, or the one
+    already queued or running for the user; poll its status endpoint for
+    progress. The job runs on the account's stored session, so log in first.
+    """
+    if not await SessionStore(session).verify_password(username, password):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid credentials. Please log in via /auth/login endpoint.",
+        )
+    job = await highlight_jobs.enqueue(username, session)
+    return HighlightJobStatus.model_validate(job, from_attributes=True)
+
+
+@router.get("/{username}/jobs/{job_id}", response_model=HighlightJobStatus)
+async def get_highlight_job(
+    job_id: int,
+    username: str = Path(...),
+    session: AsyncSession = Depends(get_session),
+):
+    job = await highlight_jobs.get(job_id, username, session)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return HighlightJobStatus.model_validate(job, from_attributes=True)
@@ -1,10 +1,40 @@
 import asyncio
-from fastapi import APIRouter, Depends, Path, HTTPException
+import json
+import time
+from datetime import datetime, timezone
+from typing import List, Literal, Optional, Tuple
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    Path,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import StreamingResponse
 from aiograpi import Client
 from aiograpi.exceptions import ClientLoginRequired, ClientError
-from ...models.models import ProfileStats
-from ...utils.dependencies import get_client
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ...models.models import (
+    ProfileStats,
+    ProfileStatsBatchRequest,
+    ProfileStatsHistoryResponse,
+    UsernamePk,
+)
+from ...utils.config_secrets import Secrets
+from ...utils.dependencies import leased_client, requires_relogin
+from ...utils.media_scanner import media_scanner
+from ...utils.profile_stats_cache import CachedStats, profile_stats_cache
+from ...utils.profile_stats_history import profile_stats_history
+from ...utils.session_manager import SessionStore
+from ...utils.session_validity import session_validity
 from ...utils.rate_limiter import rate_limiter
+from ...utils.resilience import call_upstream
+from ...utils.single_flight import single_flight
+from ...utils.user_resolver import user_resolver
+from ...database.postgresql_handler import async_session_maker, get_session
 import sentry_sdk
 import logging
 
@@ -12,77 +42,369 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
-async def retry_with_backoff(func, max_retries=3, initial_delay=5):
-    for attempt in range(max_retries):
+async def fetch_profile_stats(
+    client: Client,
+    username: str,
+    user_id: Optional[int] = None,
+    account: Optional[str] = None,
+) -> Tuple[ProfileStats, int, bool]:
+    """
+    Fetches profile stats from Instagram through the account's client (the
+    profile's own account unless given). Concurrent fetches for the same
+    username share one upstream computation.
+
+    Once the pk is known (from the resolver, or from user_info_by_username),
+    user info, the reels scan and highlights are fetched concurrently, each
+    upstream call with its own timeout. User info is required; if the reels
+    scan or highlights fail, their counts are None and the stats are marked
+    partial. They are also partial while the reels scan hasn't reached the end
+    of the feed yet. Returns the stats, the pk and whether reels_count is
+    complete.
+    """
+    key = username.lower()
+    account = account or username
+    timeout = Secrets.PROFILE_STATS_CACHE.PROFILE_STATS_CALL_TIMEOUT
+
+    def upstream(call):
+        return call_upstream(
+            lambda: asyncio.wait_for(call(), timeout), account, client.proxy
+        )
+
+    async def optional(name, awaitable):
         try:
-            return await func()
-        except ClientError as e:  # noqa: F841
-            if attempt == max_retries - 1:
+            return await awaitable
+        except Exception as e:
+            if requires_relogin(e):
                 raise
-            delay = initial_delay * (2**attempt)
-            logger.warning(f"API error. Retrying in {delay} seconds...")
-            await asyncio.sleep(delay)
-    raise HTTPException(
-        status_code=429, detail="Too many requests. Please try again later."
-    )
+            logger.warning(f"Fetching {name} for {username} failed: {str(e)}")
+            return None
 
+    async def fetch_counts(user_id, user_info):
+        reels = asyncio.create_task(
+            optional(
+                "reels",
+                media_scanner.scan(
+                    user_id,
+                    lambda cursor: upstream(
+                        lambda: client.user_medias_chunk(user_id, end_cursor=cursor)
+                    ),
+                ),
+            )
+        )
+        highlights = asyncio.create_task(
+            optional(
+                "highlights",
+                single_flight.do(
+                    ("user_highlights", user_id),
+                    lambda: upstream(lambda: client.user_highlights(user_id)),
+                ),
+            )
+        )
+        try:
+            if user_info is None:
+                user_info = await upstream(lambda: client.user_info(user_id))
+                if user_info.username.lower() != key:
+                    # The username moved to another account since we cached the pk
+                    return None
+            reels_scan, user_highlights = await asyncio.gather(reels, highlights)
+        finally:
+            reels.cancel()
+            highlights.cancel()
+        return user_info, reels_scan, user_highlights
 
-@router.get("/{username}", response_model=ProfileStats)
-async def get_profile_stats(
-    username: str = Path(...), client: Client = Depends(get_client)
-):
-    try:
-        # Check rate limit before processing the request
-        rate_limiter.check_rate_limit(username)
+    async def fetch():
+        # Only the caller that actually goes upstream counts against the limit
+        rate_limiter.check_rate_limit(account, route="profile_stats")
 
-        async def fetch_user_info():
-            return await client.user_info_by_username(username)
+        result = None
+        if user_id is not None:
+            result = await fetch_counts(user_id, None)
+            if result is None:
+                user_resolver.invalidate(username)
+        if result is None:
+            user_info = await single_flight.do(
+                ("user_info_by_username", key),
+                lambda: upstream(lambda: client.user_info_by_username(username)),
+            )
+            result = await fetch_counts(int(user_info.pk), user_info)
+        user_info, reels_scan, user_highlights = result
+        reels_count, reels_complete = reels_scan or (None, False)
 
-        user_info = await retry_with_backoff(fetch_user_info)
-        user_id = user_info.pk
+        profile_stats = ProfileStats(
+            username=username,
+            posts_count=user_info.media_count,
+            reels_count=reels_count,
+            highlights_count=(
+                len(user_highlights) if user_highlights is not None else None
+            ),
+            follower_count=user_info.follower_count,
+            following_count=user_info.following_count,
+            partial=not reels_complete or user_highlights is None,
+        )
+        return profile_stats, int(user_info.pk), reels_complete
 
-        posts_count = user_info.media_count
-        follower_count = user_info.follower_count
-        following_count = user_info.following_count
+    return await single_flight.do(("profile_stats", key), fetch)
 
-        async def fetch_user_medias():
-            return await client.user_medias(user_id, amount=1)
 
-        user_medias = await retry_with_backoff(fetch_user_medias)
-        reels_count = sum(
-            1
-            for media in user_medias
-            if media.media_type == 2 and media.product_type == "clips"
+async def refresh_profile_stats(
+    username: str, password: str, session: AsyncSession, account: Optional[str] = None
+) -> CachedStats:
+    account = account or username
+    known_pk = await user_resolver.cached(username, session)
+    async with leased_client(account, password, session) as client:
+        profile_stats, user_id, reels_complete = await fetch_profile_stats(
+            client, username, known_pk, account
         )
+    # Full user info is needed for the counts anyway, so seed the resolver
+    await user_resolver.remember(username, user_id, session)
+    # Committed together with the cache entry
+    await profile_stats_history.record(
+        user_id, profile_stats, session, reels_complete=reels_complete
+    )
+    # Partial stats are cached too, with a shorter max age, so large profiles
+    # still get cache hits while their reels are being counted
+    return await profile_stats_cache.put(profile_stats, session)
 
-        return ProfileStats(
-            username=username,
-            posts_count=posts_count,
-            reels_count=reels_count,
-            highlights_count=0,  # We'll need to implement this separately if needed
-            follower_count=follower_count,
-            following_count=following_count,
+
+async def _refresh_in_background(
+    username: str, password: str, account: Optional[str] = None
+):
+    # The request's session is closed once the response is sent
+    async with async_session_maker() as session:
+        await refresh_profile_stats(username, password, session, account)
+
+
+async def get_cached_or_refresh(
+    username: str,
+    password: str,
+    max_age: int,
+    session: AsyncSession,
+    account: Optional[str] = None,
+) -> CachedStats:
+    """
+    Returns cached stats younger than max_age seconds. Older stats are served
+    while a background refresh runs, for up to the stale-while-revalidate
+    window; past that, fresh stats are fetched.
+    """
+    entry, state = await profile_stats_cache.lookup(username, session, max_age)
+    if state == "stale":
+        profile_stats_cache.refresh_in_background(
+            username, lambda: _refresh_in_background(username, password, account)
         )
-    except HTTPException as e:
+    elif state in ("miss", "expired"):
+        entry = await refresh_profile_stats(username, password, session, account)
+    return entry
+
+
+def as_http_exception(e: Exception, username: str, account: str) -> HTTPException:
+    """
+    Maps an error from fetching a profile's stats to the HTTP error to report.
+    """
+    if isinstance(e, HTTPException):
         # This will catch the rate limit exception from our RateLimiter
-        logger.warning(f"Rate limit reached for {username}: {str(e)}")
-        raise
-    except ClientLoginRequired:
-        logger.error(f"Client not logged in for {username}")
-        raise HTTPException(
+        logger.warning(f"Request for {username} failed: {str(e)}")
+        return e
+    if isinstance(e, ClientLoginRequired):
+        logger.error(f"Client not logged in for {account}")
+        session_validity.invalidate(account)
+        return HTTPException(
             status_code=401,
             detail="Authentication required. Please log in.",
         )
-    except ClientError as e:
+    if isinstance(e, ClientError):
         logger.error(f"Client error for {username}: {str(e)}")
-        raise HTTPException(
+        return HTTPException(
             status_code=400,
             detail="Unable to fetch profile stats. The profile might be private or not exist.",
         )
-    except Exception as e:
-        logger.exception(f"Error fetching profile stats for {username}: {str(e)}")
-        sentry_sdk.capture_exception(e)
+    logger.exception(f"Error fetching profile stats for {username}: {str(e)}")
+    sentry_sdk.capture_exception(e)
+    return HTTPException(
+        status_code=500,
+        detail="An error occurred while fetching profile stats. Please try again later.",
+    )
+
+
+def _cache_headers(entry: CachedStats, max_age: int) -> dict:
+    age = int(profile_stats_cache.age(entry))
+    max_age = profile_stats_cache.max_age(entry, max_age)
+    headers = {
+        "ETag": profile_stats_cache.etag(entry[0]),
+        "Cache-Control": (
+            f"max-age={max(max_age - age, 0)}, "
+            f"stale-while-revalidate={profile_stats_cache.stale_while_revalidate}"
+        ),
+        "Age": str(age),
+    }
+    return headers
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+
+async def _batch_item(
+    username: str,
+    account: str,
+    password: str,
+    max_age: int,
+    semaphore: asyncio.Semaphore,
+) -> dict:
+    max_wait = Secrets.PROFILE_STATS_BATCH.PROFILE_STATS_BATCH_MAX_WAIT
+    deadline = time.monotonic() + max_wait
+    async with semaphore:
+        while True:
+            try:
+                async with async_session_maker() as session:
+                    entry = await get_cached_or_refresh(
+                        username, password, max_age, session, account
+                    )
+                return {"username": username, "stats": entry[0].model_dump()}
+            except Exception as e:
+                error = as_http_exception(e, username, account)
+            retry_after = (error.headers or {}).get("Retry-After")
+            if (
+                error.status_code == 429
+                and retry_after
+                and time.monotonic() + float(retry_after) <= deadline
+            ):
+                # Wait for the account's rate limit instead of failing the item;
+                # holding the semaphore slows the whole batch down with it
+                await asyncio.sleep(float(retry_after))
+                continue
+            return {
+                "username": username,
+                "error": {"status_code": error.status_code, "detail": error.detail},
+            }
+
+
+async def _stream_batch(
+    usernames: List[str], account: str, password: str, max_age: int
+):
+    semaphore = asyncio.Semaphore(
+        Secrets.PROFILE_STATS_BATCH.PROFILE_STATS_BATCH_CONCURRENCY
+    )
+    tasks = [
+        asyncio.create_task(
+            _batch_item(username, account, password, max_age, semaphore)
+        )
+        for username in usernames
+    ]
+    try:
+        for completed in asyncio.as_completed(tasks):
+            yield json.dumps(await completed) + "\n"
+    finally:
+        # The client went away; don't keep fetching for nobody
+        for task in tasks:
+            task.cancel()
+
+
+@router.post("/batch")
+async def get_profile_stats_batch(request: ProfileStatsBatchRequest = Body(...)):
+    """
+    Fetches stats for many profiles through one account. Results are streamed
+    as NDJSON in completion order, one {"username", "stats"} or
+    {"username", "error"} object per line. Lookups run concurrently, bounded by
+    PROFILE_STATS_BATCH_CONCURRENCY and the account's proxy slots; lookups hit
+    by the account's rate limit wait for it for up to
+    PROFILE_STATS_BATCH_MAX_WAIT seconds.
+    """
+    usernames = list(
+        {username.lower(): username for username in request.usernames}.values()
+    )
+    if not usernames:
+        raise HTTPException(status_code=400, detail="No usernames given")
+    if len(usernames) > Secrets.PROFILE_STATS_BATCH.PROFILE_STATS_BATCH_MAX_SIZE:
         raise HTTPException(
-            status_code=500,
-            detail="An error occurred while fetching profile stats. Please try again later.",
+            status_code=413,
+            detail=f"At most {Secrets.PROFILE_STATS_BATCH.PROFILE_STATS_BATCH_MAX_SIZE} usernames per batch",
         )
+    max_age = request.max_age
+    if max_age is None:
+        max_age = Secrets.PROFILE_STATS_CACHE.PROFILE_STATS_MAX_AGE
+    elif max_age < 0:
+        raise HTTPException(status_code=400, detail="max_age must not be negative")
+    return StreamingResponse(
+        _stream_batch(usernames, request.account, request.password, max_age),
+        media_type="application/x-ndjson",
+    )
+
+
+def _as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+@router.get("/{username}/history", response_model=ProfileStatsHistoryResponse)
+async def get_profile_stats_history(
+    password: str,
+    username: str = Path(...),
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    bucket: Optional[Literal["hour", "day", "week", "month"]] = Query(None),
+    agg: Literal["max", "min", "avg", "last"] = Query("max"),
+    limit: int = Query(1000, ge=1, le=10000),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Returns the stored stats history of a profile between start (inclusive)
+    and end (exclusive), oldest first. A row is only stored when the stats
+    changed. With bucket, rows are downsampled in SQL to one point per UTC
+    hour, day, week or month holding the agg of each count.
+    """
+    if not await SessionStore(session).verify_password(username, password):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid credentials. Please log in via /auth/login endpoint.",
+        )
+    # Bounds without an offset are taken as UTC, so they compare with the rest
+    start = _as_utc(start)
+    end = _as_utc(end)
+    if start is not None and end is not None and start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    # The mapping is only used to find the rows, so a stale one is fine
+    username_pk = await session.get(UsernamePk, username.lower())
+    if username_pk is None:
+        raise HTTPException(status_code=404, detail=f"No stats history for {username}")
+    points = await profile_stats_history.query(
+        username_pk.user_pk, session, start, end, bucket, agg, limit
+    )
+    return ProfileStatsHistoryResponse(
+        username=username,
+        user_pk=username_pk.user_pk,
+        bucket=bucket,
+        agg=agg,
+        points=points,
+    )
+
+
+@router.get("/{username}", response_model=ProfileStats)
+async def get_profile_stats(
+    request: Request,
+    response: Response,
+    password: str,
+    username: str = Path(...),
+    max_age: int = Query(Secrets.PROFILE_STATS_CACHE.PROFILE_STATS_MAX_AGE, ge=0),
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Returns cached stats younger than max_age seconds. Older stats are served
+    while a background refresh runs, for up to the stale-while-revalidate
+    window; past that, the request waits for fresh stats.
+    """
+    try:
+        entry = await get_cached_or_refresh(username, password, max_age, session)
+
+        headers = _cache_headers(entry, max_age)
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        response.headers.update(headers)
+        return entry[0]
+    except Exception as e:
+        raise as_http_exception(e, username, username)
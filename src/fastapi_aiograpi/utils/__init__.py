@@ -1,5 +1,20 @@
+from . import client_pool  # noqa
 from . import config_secrets  # noqa
 from . import dependencies  # noqa
+from . import highlight_jobs  # noqa
+from . import highlight_scraper  # noqa
+from . import highlight_snapshots  # noqa
+from . import highlight_sync  # noqa
+from . import media_downloader  # noqa
+from . import media_scanner  # noqa
+from . import password_hasher  # noqa
+from . import profile_stats_cache  # noqa
+from . import profile_stats_history  # noqa
 from . import proxy_manager  # noqa
+from . import proxy_scheduler  # noqa
 from . import rate_limiter  # noqa
+from . import resilience  # noqa
 from . import session_manager  # noqa
+from . import session_validity  # noqa
+from . import single_flight  # noqa
+from . import user_resolver  # noqa
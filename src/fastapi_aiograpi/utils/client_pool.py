@@ -0,0 +1,201 @@
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from aiograpi import Client
+from .config_secrets import Secrets
+import sentry_sdk
+import logging
+
+logger = logging.getLogger(__name__)
+
+PoolKey = Tuple[str, Optional[str]]
+
+
+@dataclass
+class ClientLease:
+    key: PoolKey
+    client: Client
+    generation: int
+    warm: bool = False
+    pooled: bool = True
+    released: bool = False
+    last_used: float = field(default_factory=time.monotonic)
+
+    @property
+    def username(self) -> str:
+        return self.key[0]
+
+
+class ClientPool:
+    """
+    Keeps warm, already-configured aiograpi clients keyed by (username, proxy).
+
+    A client is handed out to exactly one request at a time via acquire() and
+    goes back to the idle list on release(). Idle clients are evicted after
+    idle_timeout seconds, and the pool never holds more than max_size clients;
+    when it is full and nothing idle can be evicted, an overflow client is
+    created for the request and closed on release.
+    """
+
+    def __init__(self, max_size: int, idle_timeout: float):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._idle: Dict[PoolKey, List[ClientLease]] = {}
+        self._leased = 0
+        self._generations: Dict[str, int] = {}
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        logger.info(
+            f"Initialized ClientPool (max_size={max_size}, idle_timeout={idle_timeout}s)"
+        )
+
+    @property
+    def idle_count(self) -> int:
+        return sum(len(leases) for leases in self._idle.values())
+
+    @property
+    def size(self) -> int:
+        return self._leased + self.idle_count
+
+    async def acquire(self, username: str, proxy: Optional[str]) -> ClientLease:
+        """
+        Leases a client for the given username and proxy. The returned lease is
+        warm if the client was already configured by a previous request.
+        """
+        await self._evict_expired()
+        key = (username, proxy)
+        idle = self._idle.get(key)
+        if idle:
+            lease = idle.pop()
+            if not idle:
+                del self._idle[key]
+            lease.warm = True
+            lease.released = False
+            self._leased += 1
+            self.hits += 1
+            logger.debug(f"Leased pooled client for user {username}")
+            return lease
+
+        self.misses += 1
+        if self.size >= self.max_size:
+            await self._evict_least_recently_used()
+        pooled = not self._closed and self.size < self.max_size
+        if not pooled:
+            logger.warning(
+                f"Client pool is full ({self.max_size}), using an overflow client for user {username}"
+            )
+        lease = ClientLease(
+            key=key,
+            client=Client(),
+            generation=self._generations.get(username, 0),
+            pooled=pooled,
+        )
+        if pooled:
+            self._leased += 1
+        return lease
+
+    async def release(self, lease: ClientLease, reuse: bool = True):
+        """
+        Returns a leased client to the pool. Clients that must not be reused
+        (e.g. after a LoginRequired error) are closed instead.
+        """
+        if lease.released:
+            return
+        lease.released = True
+        if lease.pooled:
+            self._leased -= 1
+
+        stale = lease.generation != self._generations.get(lease.username, 0)
+        if not reuse or stale or not lease.pooled or self._closed:
+            await self._close_client(lease)
+            return
+
+        lease.last_used = time.monotonic()
+        self._idle.setdefault(lease.key, []).append(lease)
+
+    async def evict(self, username: str):
+        """
+        Drops every pooled client for a username, e.g. after logout. Clients that
+        are currently leased are closed when they are released.
+        """
+        self._generations[username] = self._generations.get(username, 0) + 1
+        evicted = []
+        for key in [key for key in self._idle if key[0] == username]:
+            evicted.extend(self._idle.pop(key))
+        for lease in evicted:
+            await self._close_client(lease)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} pooled clients for user {username}")
+
+    async def close(self):
+        """
+        Closes all idle clients and stops pooling. Called on app shutdown.
+        """
+        self._closed = True
+        idle = [lease for leases in self._idle.values() for lease in leases]
+        self._idle.clear()
+        for lease in idle:
+            await self._close_client(lease)
+        logger.info(f"Client pool closed, {len(idle)} idle clients shut down")
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": self.idle_count,
+            "leased": self._leased,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    async def _evict_expired(self):
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        for key in list(self._idle):
+            leases = self._idle[key]
+            expired.extend(lease for lease in leases if lease.last_used < deadline)
+            leases[:] = [lease for lease in leases if lease.last_used >= deadline]
+            if not leases:
+                del self._idle[key]
+        for lease in expired:
+            await self._close_client(lease)
+        if expired:
+            logger.info(f"Evicted {len(expired)} idle clients from the pool")
+
+    async def _evict_least_recently_used(self):
+        candidates = [lease for leases in self._idle.values() for lease in leases]
+        if not candidates:
+            return
+        oldest = min(candidates, key=lambda lease: lease.last_used)
+        leases = self._idle[oldest.key]
+        leases.remove(oldest)
+        if not leases:
+            del self._idle[oldest.key]
+        await self._close_client(oldest)
+
+    async def _close_client(self, lease: ClientLease):
+        # aiograpi keeps one HTTP session for the private and one for the public API
+        for attr in ("private", "public"):
+            http_session = getattr(lease.client, attr, None)
+            close = getattr(http_session, "_close", None)
+            if close is None:
+                continue
+            try:
+                await close()
+            except Exception as e:
+                logger.warning(
+                    f"Failed to close {attr} session for user {lease.username}: {str(e)}"
+                )
+                sentry_sdk.add_breadcrumb(
+                    category="client_pool",
+                    message="Failed to close client session",
+                    data={"username": lease.username, "error": str(e)},
+                    level="warning",
+                )
+
+
+client_pool = ClientPool(
+    Secrets.CLIENT_POOL.CLIENT_POOL_MAX_SIZE,
+    Secrets.CLIENT_POOL.CLIENT_POOL_IDLE_TIMEOUT,
+)
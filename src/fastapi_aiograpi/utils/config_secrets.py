@@ -7,6 +7,18 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 
+def _parse_limits(value: str) -> dict:
+    """
+    Parses "name=limit,name=limit" into a dict of int limits.
+    """
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, limit = item.split("=", 1)
+            limits[name.strip()] = int(limit)
+    return limits
+
+
 class Sentry:
     SENTRY_DSN = os.getenv("SENTRY_DSN")
     SENTRY_ENVIRONMENT = os.getenv("SENTRY_ENVIRONMENT")
@@ -15,16 +27,150 @@ class Sentry:
 class Proxy:
     PROXY_IPS = os.getenv("PROXY_IPS", "").split(",")
     logger.info(f"Loaded {len(PROXY_IPS)} proxies from environment")
+    PROXY_CHECK_CONCURRENCY = int(os.getenv("PROXY_CHECK_CONCURRENCY", "10"))
+    PROXY_CHECK_TIMEOUT = float(os.getenv("PROXY_CHECK_TIMEOUT", "10"))
+    PROXY_MONITOR_INTERVAL = float(os.getenv("PROXY_MONITOR_INTERVAL", "60"))
+    PROXY_EWMA_ALPHA = float(os.getenv("PROXY_EWMA_ALPHA", "0.3"))
+    PROXY_MAX_ERROR_RATE = float(os.getenv("PROXY_MAX_ERROR_RATE", "0.5"))
+    PROXY_MAX_CONCURRENCY = int(os.getenv("PROXY_MAX_CONCURRENCY", "4"))
+    PROXY_SLOT_TIMEOUT = float(os.getenv("PROXY_SLOT_TIMEOUT", "30"))
 
 
 class Postgres:
     POSTGRES_URL = os.getenv("POSTGRES_URL")
+    POSTGRES_POOL_SIZE = int(os.getenv("POSTGRES_POOL_SIZE", "10"))
+    POSTGRES_MAX_OVERFLOW = int(os.getenv("POSTGRES_MAX_OVERFLOW", "20"))
+    POSTGRES_POOL_TIMEOUT = float(os.getenv("POSTGRES_POOL_TIMEOUT", "30"))
+    POSTGRES_POOL_RECYCLE = int(os.getenv("POSTGRES_POOL_RECYCLE", "1800"))
+    POSTGRES_POOL_PRE_PING = (
+        os.getenv("POSTGRES_POOL_PRE_PING", "true").lower() == "true"
+    )
+
+
+class ClientPool:
+    CLIENT_POOL_MAX_SIZE = int(os.getenv("CLIENT_POOL_MAX_SIZE", "50"))
+    CLIENT_POOL_IDLE_TIMEOUT = float(os.getenv("CLIENT_POOL_IDLE_TIMEOUT", "900"))
+
+
+class SessionValidity:
+    SESSION_VALIDITY_TTL = float(os.getenv("SESSION_VALIDITY_TTL", "600"))
+
+
+class UserResolver:
+    USER_RESOLVER_CACHE_SIZE = int(os.getenv("USER_RESOLVER_CACHE_SIZE", "10000"))
+    USER_RESOLVER_MAX_AGE = float(os.getenv("USER_RESOLVER_MAX_AGE", "604800"))
+
+
+class UserCache:
+    USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+    USER_CACHE_NEGATIVE_TTL = float(os.getenv("USER_CACHE_NEGATIVE_TTL", "60"))
+
+
+class PasswordHasher:
+    PASSWORD_HASHER_WORKERS = int(os.getenv("PASSWORD_HASHER_WORKERS", "2"))
+    PASSWORD_HASHER_MAX_QUEUE = int(os.getenv("PASSWORD_HASHER_MAX_QUEUE", "100"))
+    PASSWORD_HASHER_CACHE_TTL = float(os.getenv("PASSWORD_HASHER_CACHE_TTL", "300"))
+
+
+class RateLimit:
+    RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "5"))
+    RATE_LIMIT_ROUTES = _parse_limits(os.getenv("RATE_LIMIT_ROUTES", ""))
+    RATE_LIMIT_ACCOUNTS = _parse_limits(os.getenv("RATE_LIMIT_ACCOUNTS", ""))
+    RATE_LIMIT_IDLE_TTL = float(os.getenv("RATE_LIMIT_IDLE_TTL", "600"))
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "local")
+    RATE_LIMIT_FLUSH_INTERVAL = float(os.getenv("RATE_LIMIT_FLUSH_INTERVAL", "0.5"))
+
+
+class SingleFlight:
+    SINGLE_FLIGHT_RESULT_TTL = float(os.getenv("SINGLE_FLIGHT_RESULT_TTL", "5"))
+    SINGLE_FLIGHT_MAX_RESULTS = int(os.getenv("SINGLE_FLIGHT_MAX_RESULTS", "10000"))
+
+
+class ProfileStatsCache:
+    PROFILE_STATS_MAX_AGE = int(os.getenv("PROFILE_STATS_MAX_AGE", "300"))
+    PROFILE_STATS_STALE_WHILE_REVALIDATE = int(
+        os.getenv("PROFILE_STATS_STALE_WHILE_REVALIDATE", "3600")
+    )
+    PROFILE_STATS_PARTIAL_MAX_AGE = int(
+        os.getenv("PROFILE_STATS_PARTIAL_MAX_AGE", "30")
+    )
+    PROFILE_STATS_CACHE_SIZE = int(os.getenv("PROFILE_STATS_CACHE_SIZE", "10000"))
+    PROFILE_STATS_CALL_TIMEOUT = float(os.getenv("PROFILE_STATS_CALL_TIMEOUT", "10"))
+
+
+class Resilience:
+    RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+    RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "4"))
+    BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+    BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "60"))
+    BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "1800"))
+
+
+class MediaScan:
+    MEDIA_SCAN_PAGE_BUDGET = int(os.getenv("MEDIA_SCAN_PAGE_BUDGET", "5"))
+    MEDIA_SCAN_LEASE = float(os.getenv("MEDIA_SCAN_LEASE", "180"))
+
+
+class HighlightSnapshot:
+    HIGHLIGHT_CURSOR_SECRET = os.getenv("HIGHLIGHT_CURSOR_SECRET", "")
+    HIGHLIGHT_SNAPSHOT_TTL = float(os.getenv("HIGHLIGHT_SNAPSHOT_TTL", "900"))
+    HIGHLIGHT_STREAM_BATCH_SIZE = int(os.getenv("HIGHLIGHT_STREAM_BATCH_SIZE", "5"))
+
+
+class ProfileStatsBatch:
+    PROFILE_STATS_BATCH_CONCURRENCY = int(
+        os.getenv("PROFILE_STATS_BATCH_CONCURRENCY", "4")
+    )
+    PROFILE_STATS_BATCH_MAX_SIZE = int(os.getenv("PROFILE_STATS_BATCH_MAX_SIZE", "500"))
+    PROFILE_STATS_BATCH_MAX_WAIT = float(
+        os.getenv("PROFILE_STATS_BATCH_MAX_WAIT", "120")
+    )
+
+
+class HighlightJobs:
+    HIGHLIGHT_JOB_WORKERS = int(os.getenv("HIGHLIGHT_JOB_WORKERS", "2"))
+    HIGHLIGHT_JOB_POLL_INTERVAL = float(os.getenv("HIGHLIGHT_JOB_POLL_INTERVAL", "2"))
+    HIGHLIGHT_JOB_STALE_AFTER = float(os.getenv("HIGHLIGHT_JOB_STALE_AFTER", "300"))
+    HIGHLIGHT_JOB_MAX_ATTEMPTS = int(os.getenv("HIGHLIGHT_JOB_MAX_ATTEMPTS", "5"))
+
+
+class MediaDownload:
+    MEDIA_DOWNLOAD_ENABLED = (
+        os.getenv("MEDIA_DOWNLOAD_ENABLED", "false").lower() == "true"
+    )
+    MEDIA_DOWNLOAD_DIR = os.getenv("MEDIA_DOWNLOAD_DIR", "media")
+    MEDIA_DOWNLOAD_WORKERS = int(os.getenv("MEDIA_DOWNLOAD_WORKERS", "4"))
+    MEDIA_DOWNLOAD_CHUNK_SIZE = int(os.getenv("MEDIA_DOWNLOAD_CHUNK_SIZE", "1048576"))
+    MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "60"))
+    MEDIA_DOWNLOAD_POLL_INTERVAL = float(os.getenv("MEDIA_DOWNLOAD_POLL_INTERVAL", "5"))
+    MEDIA_DOWNLOAD_RETRY_AFTER = float(os.getenv("MEDIA_DOWNLOAD_RETRY_AFTER", "300"))
+    MEDIA_DOWNLOAD_MAX_ATTEMPTS = int(os.getenv("MEDIA_DOWNLOAD_MAX_ATTEMPTS", "3"))
+
+
+class MediaExport:
+    MEDIA_EXPORT_BATCH_SIZE = int(os.getenv("MEDIA_EXPORT_BATCH_SIZE", "5000"))
 
 
 class Secrets:
     SENTRY = Sentry()
     PROXY = Proxy()
     POSTGRES = Postgres()
+    CLIENT_POOL = ClientPool()
+    SESSION_VALIDITY = SessionValidity()
+    USER_RESOLVER = UserResolver()
+    USER_CACHE = UserCache()
+    PASSWORD_HASHER = PasswordHasher()
+    RATE_LIMIT = RateLimit()
+    SINGLE_FLIGHT = SingleFlight()
+    PROFILE_STATS_CACHE = ProfileStatsCache()
+    RESILIENCE = Resilience()
+    MEDIA_SCAN = MediaScan()
+    HIGHLIGHT_SNAPSHOT = HighlightSnapshot()
+    PROFILE_STATS_BATCH = ProfileStatsBatch()
+    HIGHLIGHT_JOBS = HighlightJobs()
+    MEDIA_DOWNLOAD = MediaDownload()
+    MEDIA_EXPORT = MediaExport()
 
 
 logger.info("Secrets loaded")
@@ -1,89 +1,183 @@
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import Path, HTTPException, Depends
 from aiograpi import Client
-from aiograpi.exceptions import LoginRequired, ClientError
+from aiograpi.exceptions import LoginRequired, ClientError, ClientLoginRequired
+from .client_pool import client_pool
 from .proxy_manager import proxy_manager
+from .proxy_scheduler import proxy_scheduler
+from .resilience import account_key, call_upstream, circuit_breaker, proxy_key
+from .session_validity import session_validity
 from ..database.postgresql_handler import get_session
 from ..utils.session_manager import SessionStore
+from sqlmodel.ext.asyncio.session import AsyncSession
 import sentry_sdk
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-async def get_client(
-    password: str, username: str = Path(...), session=Depends(get_session)
+def requires_relogin(exc: Exception) -> bool:
+    """
+    Returns True if the exception means the client's session is no longer valid.
+    """
+    if isinstance(exc, (LoginRequired, ClientLoginRequired)):
+        return True
+    return isinstance(exc, HTTPException) and exc.status_code == 401
+
+
+async def _ensure_session(
+    client: Client,
+    username: str,
+    password: Optional[str],
+    proxy: str,
+    session_store: SessionStore,
+    configured: bool,
 ):
     """
-    Retrieves an aiograpi Client instance with session and proxy settings for the given username.
+    Makes sure the client has a valid session, applying stored session and proxy
+    settings to fresh clients and logging in if needed. The get_timeline_feed()
+    check is skipped while the account's session is within its validity TTL.
+    """
+    has_session = configured
+    if not configured:
+        client.delay_range = [1, 3]  # Add random delay between requests
+        client.set_proxy(f"http://{proxy}")
+
+        session_data = await session_store.get_session(username)
+        if session_data:
+            logger.info(f"Using existing session for user {username}")
+            client.set_settings(session_data)
+            sentry_sdk.set_context(
+                "session", {"username": username, "status": "existing"}
+            )
+            has_session = True
+
+    if has_session:
+        if session_validity.is_valid(username):
+            return
+        try:
+            # Check if session is valid
+            await call_upstream(client.get_timeline_feed, username, proxy)
+            logger.info("Session is valid")
+            session_validity.mark_valid(username)
+            return
+        except (LoginRequired, ClientError) as e:
+            session_validity.invalidate(username)
+            logger.warning(
+                f"Session is invalid for user {username}, need to re-login: {str(e)}"
+            )
+
+    logger.info(f"No valid session for user {username}, attempting to login")
+    # Here, instead of raising an exception, attempt to log in safely
+    # Background work has no password and can only use the stored session
+    if not password or not await session_store.verify_password(username, password):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid credentials. Please log in via /auth/login endpoint.",
+        )
+
+    try:
+        await call_upstream(lambda: client.login(username, password), username, proxy)
+        logger.info(f"Login successful for user {username}")
+        session_validity.mark_valid(username)
+        await session_store.save_session(username, client.get_settings(), proxy)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Login failed for user {username}: {str(e)}")
+        raise HTTPException(
+            status_code=401,
+            detail="Authentication failed. Please log in via /auth/login endpoint.",
+        )
+
+
+@asynccontextmanager
+async def leased_client(username: str, password: Optional[str], session: AsyncSession):
+    """
+    Leases an aiograpi Client instance with session and proxy settings for the given username.
+    The client comes from the shared client pool and goes back to it when the block exits.
+    Use this directly for work that outlives a request (background refreshes, streaming).
+    Without a password, only the account's stored session can be used.
     """
-    client = Client()
-    client.delay_range = [1, 3]  # Add random delay between requests
     session_store = SessionStore(session)
+    lease = None
+    proxy = None
+    slot_acquired = False
 
     try:
-        session_data = session_store.get_session(username)
-        proxy = session_store.get_proxy_for_user(username)
+        # Fail fast while Instagram is throttling the account
+        circuit_breaker.check_open(account_key(username))
+
+        proxy = await session_store.get_proxy_for_user(username)
+
+        if proxy and (
+            proxy_manager.is_degraded(proxy)
+            or circuit_breaker.is_open(proxy_key(proxy))
+        ):
+            logger.warning(
+                f"Proxy {proxy} of user {username} is unhealthy, reassigning"
+            )
+            proxy = None
 
         if not proxy:
             logger.info(
-                f"No proxy found for user {username}, attempting to get a working proxy"
+                f"No proxy found for user {username}, assigning the least loaded proxy"
             )
-            proxy = await proxy_manager.get_working_proxy()
+            proxy = await proxy_scheduler.assign_proxy(username)
             logger.info(f"Assigned proxy {proxy} to user {username}")
-            session_store.assign_proxy(username, proxy)
+            await session_store.assign_proxy(username, proxy)
+        else:
+            proxy_scheduler.register_account(username, proxy)
 
-        client.set_proxy(f"http://{proxy}")
+        await proxy_scheduler.acquire(proxy)
+        slot_acquired = True
 
-        if session_data:
-            logger.info(f"Using existing session for user {username}")
-            client.set_settings(session_data)
-            sentry_sdk.set_context(
-                "session", {"username": username, "status": "existing"}
-            )
-            try:
-                await client.get_timeline_feed()  # Check if session is valid
-                logger.info("Session is valid")
-                return client
-            except (LoginRequired, ClientError) as e:
-                logger.warning(
-                    f"Session is invalid for user {username}, need to re-login: {str(e)}"
-                )
-                session_data = None  # Force re-login
-
-        if not session_data:
-            logger.info(f"No valid session for user {username}, attempting to login")
-            # Here, instead of raising an exception, attempt to log in safely
-            if not session_store.verify_password(username, password):
-                raise HTTPException(
-                    status_code=401,
-                    detail="Invalid credentials. Please log in via /auth/login endpoint.",
-                )
-
-            try:
-                await client.login(username, password)
-                logger.info(f"Login successful for user {username}")
-                session_store.save_session(username, client.get_settings(), proxy)
-                return client
-            except Exception as e:
-                logger.error(f"Login failed for user {username}: {str(e)}")
-                raise HTTPException(
-                    status_code=401,
-                    detail="Authentication failed. Please log in via /auth/login endpoint.",
-                )
+        lease = await client_pool.acquire(username, proxy)
+        if lease.warm:
+            logger.info(f"Reusing pooled client for user {username}")
+        await _ensure_session(
+            lease.client, username, password, proxy, session_store, lease.warm
+        )
 
         sentry_sdk.set_context("proxy", {"used": proxy})
         sentry_sdk.add_breadcrumb(
             category="auth",
             message="Client initialized",
-            data={"username": username, "proxy": proxy},
+            data={"username": username, "proxy": proxy, "pooled": lease.warm},
         )
-        return client
-    except HTTPException:
-        raise
     except Exception as e:
+        if lease:
+            await client_pool.release(lease, reuse=False)
+        if slot_acquired:
+            proxy_scheduler.release(proxy)
+        if isinstance(e, HTTPException):
+            raise
         logger.exception(f"Failed to initialize client for user {username}: {e}")
         sentry_sdk.capture_exception(e)
         raise HTTPException(
             status_code=503,
             detail="Failed to initialize client. Please try again later.",
         )
+
+    reuse = True
+    try:
+        yield lease.client
+    except Exception as e:
+        if requires_relogin(e):
+            reuse = False
+            session_validity.invalidate(username)
+        raise
+    finally:
+        await client_pool.release(lease, reuse=reuse)
+        proxy_scheduler.release(proxy)
+
+
+async def get_client(
+    password: str, username: str = Path(...), session=Depends(get_session)
+):
+    """
+    Leases an aiograpi Client instance for the duration of the request.
+    """
+    async with leased_client(username, password, session) as client:
+        yield client
@@ -0,0 +1,319 @@
+import asyncio
+import math
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from aiograpi.exceptions import ClientError, ClientLoginRequired
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .config_secrets import Secrets
+from .dependencies import leased_client
+from .highlight_scraper import (
+    fetch_highlight_list,
+    rate_limit_delay,
+    sync_highlight,
+)
+from .highlight_sync import highlight_sync
+from .session_validity import session_validity
+from .user_resolver import user_resolver
+from ..database.postgresql_handler import async_session_maker
+from ..models.models import HighlightScrapeJob
+import sentry_sdk
+import logging
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class HighlightJobQueue:
+    """
+    Runs highlight scrapes as background jobs from the highlightscrapejob table.
+
+    Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+    workers across processes can share the table without claiming a job twice.
+    A running job records its progress after every highlight, which doubles as
+    a heartbeat: jobs not updated for stale_after seconds (their worker died)
+    are claimed again. Jobs hit by a rate limit or an open circuit breaker are
+    requeued for after the Retry-After time, up to max_attempts claims.
+
+    Jobs run on the account's stored session, through the same client pool,
+    proxy slots, rate limits and circuit breakers as requests.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        poll_interval: float,
+        stale_after: float,
+        max_attempts: int,
+    ):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self.completed = 0
+        self.failed = 0
+        self.requeued = 0
+        logger.info(
+            f"Initialized HighlightJobQueue (workers={workers}, poll_interval={poll_interval}s)"
+        )
+
+    async def enqueue(self, username: str, session: AsyncSession) -> HighlightScrapeJob:
+        """
+        Queues a scrape of the user's highlights, or returns the job already
+        queued or running for them.
+        """
+        key = username.lower()
+        while True:
+            # The partial unique index allows one active job per user, so
+            # concurrent requests can't both insert one
+            statement = (
+                insert(HighlightScrapeJob)
+                .values(
+                    username=key,
+                    status="queued",
+                    attempts=0,
+                    highlights_done=0,
+                    items_stored=0,
+                    run_after=datetime.now(timezone.utc),
+                    created_at=datetime.now(timezone.utc),
+                    updated_at=datetime.now(timezone.utc),
+                )
+                .on_conflict_do_nothing(
+                    index_elements=["username"],
+                    # Inlined, so Postgres can match it to the index predicate
+                    index_where=text("status IN ('queued', 'running')"),
+                )
+                .returning(HighlightScrapeJob)
+                .execution_options(synchronize_session=False)
+            )
+            job = (await session.exec(statement)).scalars().first()
+            if job is not None:
+                await session.commit()
+                logger.info(f"Queued highlight scrape job {job.id} for {key}")
+                break
+            statement = select(HighlightScrapeJob).where(
+                HighlightScrapeJob.username == key,
+                HighlightScrapeJob.status.in_(ACTIVE_STATUSES),
+            )
+            job = (await session.exec(statement)).first()
+            await session.commit()
+            if job is not None:
+                break
+            # The active job finished in between, try again
+        self._wakeup.set()
+        return job
+
+    async def get(
+        self, job_id: int, username: str, session: AsyncSession
+    ) -> Optional[HighlightScrapeJob]:
+        job = await session.get(HighlightScrapeJob, job_id)
+        if job is None or job.username != username.lower():
+            return None
+        return job
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [
+            asyncio.create_task(self._work(index)) for index in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} highlight job workers")
+
+    async def aclose(self):
+        for task in self._tasks:
+            task.cancel()
+        # Interrupted jobs are picked up again once they go stale
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "completed": self.completed,
+            "failed": self.failed,
+            "requeued": self.requeued,
+        }
+
+    async def _claim(self) -> Optional[HighlightScrapeJob]:
+        now = datetime.now(timezone.utc)
+        stale = now - timedelta(seconds=self.stale_after)
+        # Jobs that keep killing or hanging their worker aren't retried forever
+        abandoned = (
+            update(HighlightScrapeJob)
+            .where(
+                HighlightScrapeJob.status == "running",
+                HighlightScrapeJob.updated_at < stale,
+                HighlightScrapeJob.attempts >= self.max_attempts,
+            )
+            .values(
+                status="failed",
+                error="The job stopped responding too many times",
+                updated_at=now,
+                finished_at=now,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        candidate = (
+            select(HighlightScrapeJob.id)
+            .where(
+                (
+                    (HighlightScrapeJob.status == "queued")
+                    & (HighlightScrapeJob.run_after <= now)
+                )
+                | (
+                    (HighlightScrapeJob.status == "running")
+                    & (HighlightScrapeJob.updated_at < stale)
+                    & (HighlightScrapeJob.attempts < self.max_attempts)
+                )
+            )
+            .order_by(HighlightScrapeJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        statement = (
+            update(HighlightScrapeJob)
+            .where(HighlightScrapeJob.id == candidate)
+            .values(
+                status="running",
+                attempts=HighlightScrapeJob.attempts + 1,
+                updated_at=now,
+            )
+            .returning(HighlightScrapeJob)
+            .execution_options(synchronize_session=False)
+        )
+        async with async_session_maker() as session:
+            result = await session.exec(abandoned)
+            if result.rowcount:
+                self.failed += result.rowcount
+                logger.warning(f"Failed {result.rowcount} abandoned highlight jobs")
+            job = (await session.exec(statement)).scalars().first()
+            await session.commit()
+            return job
+
+    async def _work(self, index: int):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.error(f"Highlight job worker {index} failed to claim: {str(e)}")
+                sentry_sdk.capture_exception(e)
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(job)
+            except Exception as e:
+                # The job goes stale and is claimed again
+                logger.error(
+                    f"Highlight job worker {index} failed to record job {job.id}: {str(e)}"
+                )
+                sentry_sdk.capture_exception(e)
+
+    async def _run(self, job: HighlightScrapeJob):
+        async with async_session_maker() as session:
+            session.add(job)
+            try:
+                await self._scrape(job, session)
+                job.status = "done"
+                job.finished_at = datetime.now(timezone.utc)
+                self.completed += 1
+                logger.info(
+                    f"Highlight scrape job {job.id} for {job.username} done: {job.items_stored} new items"
+                )
+            except Exception as e:
+                await session.rollback()
+                # Back to the last committed progress
+                await session.refresh(job)
+                self._record_failure(job, e)
+            job.updated_at = datetime.now(timezone.utc)
+            await session.commit()
+
+    async def _scrape(self, job: HighlightScrapeJob, session: AsyncSession):
+        highlights = None
+        while True:
+            async with leased_client(job.username, None, session) as client:
+                if highlights is None:
+                    user_id = await user_resolver.resolve(client, job.username, session)
+                    highlights = await fetch_highlight_list(
+                        client, job.username, user_id
+                    )
+                    job.highlights_total = len(highlights)
+                    job.highlights_done = 0
+                    state = await highlight_sync.load(
+                        user_id, job.username, highlights, session
+                    )
+                try:
+                    for highlight in highlights[job.highlights_done :]:
+                        media = await sync_highlight(
+                            client, job.username, user_id, highlight, state, session
+                        )
+                        job.highlights_done += 1
+                        job.items_stored += sum(len(item.media_urls) for item in media)
+                        job.updated_at = datetime.now(timezone.utc)
+                        await session.commit()
+                    return
+                except HTTPException as e:
+                    delay = rate_limit_delay(e)
+                    if delay is None:
+                        raise
+            # Wait out the per-highlight rate limit without holding the proxy
+            # slot, then carry on with the next highlight. The heartbeat keeps
+            # the job from being reclaimed meanwhile.
+            job.updated_at = datetime.now(timezone.utc)
+            await session.commit()
+            logger.info(
+                f"Highlight scrape job {job.id} rate limited, resuming in {delay}s"
+            )
+            await asyncio.sleep(delay)
+
+    def _record_failure(self, job: HighlightScrapeJob, e: Exception):
+        retry_after = None
+        if isinstance(e, HTTPException):
+            detail = str(e.detail)
+            if e.status_code in (429, 503) and e.headers:
+                retry_after = e.headers.get("Retry-After")
+        elif isinstance(e, ClientLoginRequired):
+            session_validity.invalidate(job.username)
+            detail = "Authentication required. Please log in."
+        elif isinstance(e, ClientError):
+            detail = f"Instagram error: {str(e)}"
+        else:
+            logger.exception(f"Highlight scrape job {job.id} failed: {str(e)}")
+            sentry_sdk.capture_exception(e)
+            detail = "Unexpected error"
+
+        job.error = detail
+        if retry_after is not None and job.attempts < self.max_attempts:
+            job.status = "queued"
+            job.run_after = datetime.now(timezone.utc) + timedelta(
+                seconds=math.ceil(float(retry_after))
+            )
+            self.requeued += 1
+            logger.warning(
+                f"Highlight scrape job {job.id} requeued in {retry_after}s: {detail}"
+            )
+        else:
+            job.status = "failed"
+            job.finished_at = datetime.now(timezone.utc)
+            self.failed += 1
+            logger.warning(f"Highlight scrape job {job.id} failed: {detail}")
+
+
+highlight_jobs = HighlightJobQueue(
+    Secrets.HIGHLIGHT_JOBS.HIGHLIGHT_JOB_WORKERS,
+    Secrets.HIGHLIGHT_JOBS.HIGHLIGHT_JOB_POLL_INTERVAL,
+    Secrets.HIGHLIGHT_JOBS.HIGHLIGHT_JOB_STALE_AFTER,
+    Secrets.HIGHLIGHT_JOBS.HIGHLIGHT_JOB_MAX_ATTEMPTS,
+)
@@ -0,0 +1,146 @@
+from typing import List, Optional
+from aiograpi import Client
+from fastapi import HTTPException
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .highlight_sync import highlight_sync
+from .rate_limiter import rate_limiter
+from .resilience import call_upstream
+from .single_flight import single_flight
+from ..models.models import HighlightMedia, HighlightSyncState, MediaMetadata
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+async def fetch_highlight_list(
+    client: Client, username: str, user_id: int
+) -> List[dict]:
+    async def fetch_highlights():
+        # Only the caller that actually goes upstream counts against the limit
+        rate_limiter.check_rate_limit(username, route="highlights")
+        return await call_upstream(
+            lambda: client.user_highlights(user_id), username, client.proxy
+        )
+
+    highlights = await single_flight.do(("user_highlights", user_id), fetch_highlights)
+    return [
+        {
+            "id": highlight.id,
+            "pk": highlight.pk,
+            "title": highlight.title,
+            "media_count": highlight.media_count,
+            "latest_reel_media": highlight.latest_reel_media,
+        }
+        for highlight in highlights
+    ]
+
+
+async def expand_highlight(
+    client: Client, username: str, user_id: int, highlight: dict
+) -> List[dict]:
+    """
+    Returns MediaMetadata rows for the highlight's items. Each expansion is an
+    upstream call of its own, so it counts against the account's
+    highlight_info rate limit.
+    """
+    pk = highlight["pk"]
+
+    async def fetch_highlight_info():
+        # Only the caller that actually goes upstream counts against the limit
+        rate_limiter.check_rate_limit(username, route="highlight_info")
+        return await call_upstream(
+            lambda: client.highlight_info(pk), username, client.proxy
+        )
+
+    # user_highlights returns highlights without their items
+    info = await single_flight.do(("highlight_info", pk), fetch_highlight_info)
+    rows = []
+    for item in info.items:
+        url = item.video_url or item.thumbnail_url
+        if not url:
+            continue
+        rows.append(
+            {
+                "media_id": item.id,
+                "media_pk": int(item.pk),
+                "highlight_id": highlight["id"],
+                "url": str(url),
+                "media_type": item.media_type,
+                "product_type": item.product_type or "",
+                "user_id": user_id,
+                "username": username.lower(),
+                "caption_text": None,
+                "like_count": None,
+                "comment_count": None,
+            }
+        )
+    return rows
+
+
+async def store_new_items(
+    rows: List[dict], session: AsyncSession
+) -> List[HighlightMedia]:
+    """
+    Stores the items not seen before, without committing. Returns the new
+    items' URLs per highlight; highlights without new items are left out.
+    """
+    new_items = set()
+    if rows:
+        # Item URLs are signed and change over time, so "seen" goes by item id
+        statement = select(MediaMetadata.media_id).where(
+            MediaMetadata.media_id.in_([row["media_id"] for row in rows])
+        )
+        stored_ids = set((await session.exec(statement)).all())
+        rows = [row for row in rows if row["media_id"] not in stored_ids]
+    if rows:
+        # Rows a concurrent request stored meanwhile don't come back
+        statement = (
+            insert(MediaMetadata)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["media_id", "url"])
+            .returning(MediaMetadata.media_id, MediaMetadata.url)
+        )
+        new_items = set((await session.exec(statement)).all())
+
+    page = {}
+    for row in rows:
+        if (row["media_id"], row["url"]) in new_items:
+            page.setdefault(row["highlight_id"], []).append(row["url"])
+    return [
+        HighlightMedia(highlight_id=highlight_id, media_urls=media_urls)
+        for highlight_id, media_urls in page.items()
+    ]
+
+
+async def sync_highlight(
+    client: Client,
+    username: str,
+    user_id: int,
+    highlight: dict,
+    state: HighlightSyncState,
+    session: AsyncSession,
+) -> List[HighlightMedia]:
+    """
+    Stores the highlight's new items and advances its watermark, without
+    committing. Highlights unchanged since their last sync aren't expanded.
+    """
+    if highlight_sync.is_current(state, highlight):
+        return []
+    rows = await expand_highlight(client, username, user_id, highlight)
+    media = await store_new_items(rows, session)
+    highlight_sync.advance(state, highlight)
+    session.add(state)
+    return media
+
+
+def rate_limit_delay(e: HTTPException) -> Optional[float]:
+    """
+    Returns the Retry-After of a rate limit rejection, or None for any other
+    error. Background scrapes wait this long, without their client lease, and
+    carry on instead of failing.
+    """
+    if e.status_code != 429:
+        return None
+    return float(e.headers["Retry-After"])
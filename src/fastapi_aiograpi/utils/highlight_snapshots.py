@@ -0,0 +1,165 @@
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from sqlmodel import delete
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .config_secrets import Secrets
+from ..models.models import HighlightMedia, HighlightSnapshot
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HighlightSnapshots:
+    """
+    Server-side snapshots of a user's highlight list for cursor pagination.
+
+    The first page fetches the highlight list once and stores it in the
+    highlightsnapshot table; later pages read it from there, so pagination is
+    stable and needs no further user_highlights calls. Each served page is
+    stored with the snapshot too, so repeating a cursor returns the same page.
+
+    Cursors are opaque: the snapshot id, username and offset, signed with an
+    HMAC so clients can't forge positions or read other users' snapshots.
+    Snapshots expire after ttl seconds.
+    """
+
+    def __init__(self, secret: str, ttl: float):
+        if secret:
+            self._key = secret.encode()
+        else:
+            # Cursors then only work within this process
+            logger.warning(
+                "HIGHLIGHT_CURSOR_SECRET is not set, using a per-process random key"
+            )
+            self._key = secrets.token_bytes(32)
+        self.ttl = ttl
+        self.created = 0
+        self.expired = 0
+        self.page_hits = 0
+        logger.info(f"Initialized HighlightSnapshots (ttl={ttl}s)")
+
+    def encode_cursor(self, snapshot_id: str, username: str, offset: int) -> str:
+        payload = json.dumps(
+            {"s": snapshot_id, "u": username.lower(), "o": offset},
+            separators=(",", ":"),
+        ).encode()
+        signature = hmac.new(self._key, payload, hashlib.sha256).digest()[:16]
+        return f"{_b64encode(payload)}.{_b64encode(signature)}"
+
+    def decode_cursor(self, cursor: str, username: str) -> Tuple[str, int]:
+        """
+        Returns (snapshot id, offset). Raises 400 for cursors that weren't
+        issued by us for this username.
+        """
+        try:
+            encoded_payload, encoded_signature = cursor.split(".", 1)
+            payload = _b64decode(encoded_payload)
+            signature = _b64decode(encoded_signature)
+            expected = hmac.new(self._key, payload, hashlib.sha256).digest()[:16]
+            if not hmac.compare_digest(signature, expected):
+                raise ValueError("bad signature")
+            data = json.loads(payload)
+            if data["u"] != username.lower():
+                raise ValueError("cursor belongs to another user")
+            return str(data["s"]), int(data["o"])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Rejected highlight cursor for {username}: {str(e)}")
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    async def create(
+        self,
+        username: str,
+        user_id: int,
+        highlights: List[dict],
+        session: AsyncSession,
+    ) -> HighlightSnapshot:
+        snapshot = HighlightSnapshot(
+            id=uuid.uuid4().hex,
+            username=username.lower(),
+            user_id=user_id,
+            highlights=highlights,
+        )
+        session.add(snapshot)
+        self.created += 1
+        if self.created % 100 == 1:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.ttl)
+            await session.exec(
+                delete(HighlightSnapshot).where(HighlightSnapshot.created_at < cutoff)
+            )
+        await session.commit()
+        return snapshot
+
+    async def get(self, snapshot_id: str, session: AsyncSession) -> HighlightSnapshot:
+        """
+        Returns the snapshot, or raises 410 if it has expired.
+        """
+        snapshot = await session.get(HighlightSnapshot, snapshot_id)
+        if snapshot is not None:
+            created_at = snapshot.created_at
+            if created_at.tzinfo is None:
+                created_at = created_at.replace(tzinfo=timezone.utc)
+            age = (datetime.now(timezone.utc) - created_at).total_seconds()
+            if age < self.ttl:
+                return snapshot
+        self.expired += 1
+        raise HTTPException(
+            status_code=410,
+            detail="Cursor has expired. Request the first page again without a cursor.",
+        )
+
+    def get_page(
+        self, snapshot: HighlightSnapshot, offset: int, limit: int
+    ) -> Optional[List[HighlightMedia]]:
+        page = snapshot.pages.get(_page_key(offset, limit))
+        if page is None:
+            return None
+        self.page_hits += 1
+        return [HighlightMedia(**highlight) for highlight in page]
+
+    async def save_page(
+        self,
+        snapshot: HighlightSnapshot,
+        offset: int,
+        limit: int,
+        page: List[HighlightMedia],
+        session: AsyncSession,
+    ):
+        # Reassign so the JSON column is marked as changed
+        snapshot.pages = {
+            **snapshot.pages,
+            _page_key(offset, limit): [highlight.model_dump() for highlight in page],
+        }
+        session.add(snapshot)
+        await session.commit()
+
+    def stats(self) -> dict:
+        return {
+            "created": self.created,
+            "expired": self.expired,
+            "page_hits": self.page_hits,
+        }
+
+
+def _page_key(offset: int, limit: int) -> str:
+    return f"{offset}:{limit}"
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+highlight_snapshots = HighlightSnapshots(
+    Secrets.HIGHLIGHT_SNAPSHOT.HIGHLIGHT_CURSOR_SECRET,
+    Secrets.HIGHLIGHT_SNAPSHOT.HIGHLIGHT_SNAPSHOT_TTL,
+)
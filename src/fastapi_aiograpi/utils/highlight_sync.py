@@ -0,0 +1,95 @@
+from datetime import datetime, timezone
+from typing import List
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.models import HighlightSyncState
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HighlightSync:
+    """
+    Per-user watermarks for incremental highlight syncs, kept in the
+    highlightsyncstate table.
+
+    user_highlights already reports each highlight's item count and the time of
+    its latest item. A highlight whose count and latest item time are the same
+    as when its items were last stored has no new items, so it isn't expanded
+    with highlight_info again. Watermarks are only advanced together with the
+    stored items, in the same transaction.
+    """
+
+    def __init__(self):
+        self.skipped = 0
+        self.expanded = 0
+        logger.info("Initialized HighlightSync")
+
+    async def load(
+        self,
+        user_id: int,
+        username: str,
+        highlights: List[dict],
+        session: AsyncSession,
+    ) -> HighlightSyncState:
+        """
+        Returns the user's sync state, with highlights that are no longer in
+        the highlight list dropped. Doesn't commit.
+        """
+        # Concurrent first syncs of a user would otherwise race on the insert
+        await session.exec(
+            insert(HighlightSyncState)
+            .values(
+                user_id=user_id,
+                username=username.lower(),
+                highlights={},
+                updated_at=datetime.now(timezone.utc),
+            )
+            .on_conflict_do_nothing(index_elements=["user_id"])
+        )
+        state = await session.get(HighlightSyncState, user_id)
+        current = {highlight["pk"] for highlight in highlights}
+        if set(state.highlights) - current:
+            state.highlights = {
+                pk: watermark
+                for pk, watermark in state.highlights.items()
+                if pk in current
+            }
+            session.add(state)
+        return state
+
+    def is_current(self, state: HighlightSyncState, highlight: dict) -> bool:
+        """
+        Whether the highlight's items are all stored already. Highlights from
+        snapshots taken before watermarks existed never are.
+        """
+        watermark = state.highlights.get(highlight["pk"])
+        if (
+            watermark is not None
+            and highlight.get("media_count") is not None
+            and watermark == _watermark(highlight)
+        ):
+            self.skipped += 1
+            return True
+        self.expanded += 1
+        return False
+
+    def advance(self, state: HighlightSyncState, highlight: dict):
+        if highlight.get("media_count") is None:
+            return
+        # Reassign so the JSON column is marked as changed
+        state.highlights = {**state.highlights, highlight["pk"]: _watermark(highlight)}
+        state.updated_at = datetime.now(timezone.utc)
+
+    def stats(self) -> dict:
+        return {"skipped": self.skipped, "expanded": self.expanded}
+
+
+def _watermark(highlight: dict) -> dict:
+    return {
+        "media_count": highlight["media_count"],
+        "latest_reel_media": highlight.get("latest_reel_media"),
+    }
+
+
+highlight_sync = HighlightSync()
@@ -0,0 +1,280 @@
+import asyncio
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+import httpx
+from sqlmodel import select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from fastapi import HTTPException
+from .config_secrets import Secrets
+from .proxy_scheduler import proxy_scheduler
+from .session_manager import SessionStore
+from ..database.postgresql_handler import async_session_maker
+from ..models.models import MediaMetadata
+import sentry_sdk
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MediaDownloader:
+    """
+    Downloads stored media to local disk, so consumers don't depend on expiring
+    CDN URLs.
+
+    Workers claim mediametadata rows without a local_path using
+    SELECT ... FOR UPDATE SKIP LOCKED, like the highlight jobs, and stream each
+    file to disk in chunk_size pieces through the account's proxy, on one
+    shared httpx client per proxy. Each download takes a request slot on the
+    proxy from the proxy scheduler, like API requests do. Media of accounts
+    without a proxy isn't downloaded, rather than exposing the server's IP. Files are named by the SHA-256 of their
+    content, so media stored under several rows or URLs is kept once. Bytes go
+    to a partial file per row first; a retry resumes it with a Range request.
+    A claimed row that isn't finished within retry_after seconds, because the
+    download failed or its worker died, is claimed again, up to max_attempts
+    times.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        workers: int,
+        chunk_size: int,
+        timeout: float,
+        poll_interval: float,
+        retry_after: float,
+        max_attempts: int,
+    ):
+        self.directory = directory
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self._http_clients: Dict[str, httpx.AsyncClient] = {}
+        self._tasks: List[asyncio.Task] = []
+        self.downloaded = 0
+        self.deduplicated = 0
+        self.resumed = 0
+        self.failed = 0
+        self.no_proxy = 0
+        self.bytes = 0
+        logger.info(
+            f"Initialized MediaDownloader (directory={directory}, workers={workers})"
+        )
+
+    def _get_http_client(self, proxy: str) -> httpx.AsyncClient:
+        client = self._http_clients.get(proxy)
+        if client is None or client.is_closed:
+            proxy_url = f"http://{proxy}"
+            client = httpx.AsyncClient(
+                proxies={"http://": proxy_url, "https://": proxy_url},
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=self.workers,
+                    max_keepalive_connections=self.workers,
+                ),
+            )
+            self._http_clients[proxy] = client
+        return client
+
+    def start(self):
+        if self._tasks:
+            return
+        os.makedirs(os.path.join(self.directory, "partial"), exist_ok=True)
+        self._tasks = [
+            asyncio.create_task(self._work(index)) for index in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} media download workers")
+
+    async def aclose(self):
+        for task in self._tasks:
+            task.cancel()
+        # Interrupted downloads resume from their partial file once claimed again
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        clients = list(self._http_clients.values())
+        self._http_clients.clear()
+        for client in clients:
+            await client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "downloaded": self.downloaded,
+            "deduplicated": self.deduplicated,
+            "resumed": self.resumed,
+            "failed": self.failed,
+            "no_proxy": self.no_proxy,
+            "bytes": self.bytes,
+        }
+
+    async def _claim(self, session: AsyncSession) -> Optional[MediaMetadata]:
+        now = datetime.now(timezone.utc)
+        retry_before = now - timedelta(seconds=self.retry_after)
+        candidate = (
+            select(MediaMetadata.id)
+            .where(
+                MediaMetadata.local_path.is_(None),
+                MediaMetadata.download_attempts < self.max_attempts,
+                (MediaMetadata.download_started_at.is_(None))
+                | (MediaMetadata.download_started_at < retry_before),
+            )
+            .order_by(MediaMetadata.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        statement = (
+            update(MediaMetadata)
+            .where(MediaMetadata.id == candidate)
+            .values(
+                download_attempts=MediaMetadata.download_attempts + 1,
+                download_started_at=now,
+            )
+            .returning(MediaMetadata)
+            .execution_options(synchronize_session=False)
+        )
+        media = (await session.exec(statement)).scalars().first()
+        await session.commit()
+        return media
+
+    async def _work(self, index: int):
+        while True:
+            try:
+                async with async_session_maker() as session:
+                    media = await self._claim(session)
+                    if media is not None:
+                        await self._run(media, session)
+            except Exception as e:
+                logger.error(f"Media download worker {index} failed: {str(e)}")
+                sentry_sdk.capture_exception(e)
+                media = None
+            if media is None:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run(self, media: MediaMetadata, session: AsyncSession):
+        # Another row of the same media may have been downloaded already
+        statement = (
+            select(MediaMetadata.local_path, MediaMetadata.content_hash)
+            .where(
+                MediaMetadata.media_id == media.media_id,
+                MediaMetadata.local_path.is_not(None),
+            )
+            .limit(1)
+        )
+        stored = (await session.exec(statement)).first()
+        if stored is not None:
+            local_path, content_hash = stored
+            self.deduplicated += 1
+        else:
+            # Stored rows carry the username lowercased
+            proxy = await SessionStore(session).find_proxy(media.username)
+            # Don't hold a database connection for the length of the download
+            await session.commit()
+            if proxy is None:
+                # The row is claimed again after retry_after, up to max_attempts
+                self.no_proxy += 1
+                logger.warning(
+                    f"Not downloading media {media.media_id}: no proxy for {media.username}"
+                )
+                return
+            try:
+                await proxy_scheduler.acquire(proxy)
+                try:
+                    local_path, content_hash = await self._download(media, proxy)
+                finally:
+                    proxy_scheduler.release(proxy)
+            except Exception as e:
+                self.failed += 1
+                logger.warning(
+                    f"Failed to download media {media.media_id} (attempt {media.download_attempts}): {str(e)}"
+                )
+                if not isinstance(e, (httpx.HTTPError, HTTPException)):
+                    sentry_sdk.capture_exception(e)
+                return
+
+        await session.exec(
+            update(MediaMetadata)
+            .where(
+                MediaMetadata.media_id == media.media_id,
+                MediaMetadata.local_path.is_(None),
+            )
+            .values(local_path=local_path, content_hash=content_hash)
+            .execution_options(synchronize_session=False)
+        )
+        await session.commit()
+
+    async def _download(self, media: MediaMetadata, proxy: str) -> Tuple[str, str]:
+        """
+        Streams the media to its partial file, resuming what an earlier attempt
+        left, and moves it to its content-addressed path. Returns (local path,
+        SHA-256 hex digest).
+        """
+        partial_path = os.path.join(self.directory, "partial", f"{media.id}.part")
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        digest = hashlib.sha256()
+
+        client = self._get_http_client(proxy)
+        async with client.stream("GET", media.url, headers=headers) as response:
+            if offset and response.status_code == 416:
+                # The previous attempt got every byte but failed afterwards
+                await asyncio.to_thread(
+                    _hash_file, partial_path, digest, self.chunk_size
+                )
+            else:
+                response.raise_for_status()
+                if offset and response.status_code == 206:
+                    self.resumed += 1
+                    await asyncio.to_thread(
+                        _hash_file, partial_path, digest, self.chunk_size
+                    )
+                    mode = "ab"
+                else:
+                    # The server ignored the range, start over
+                    mode = "wb"
+                file = await asyncio.to_thread(open, partial_path, mode)
+                try:
+                    async for chunk in response.aiter_bytes(self.chunk_size):
+                        digest.update(chunk)
+                        await asyncio.to_thread(file.write, chunk)
+                        self.bytes += len(chunk)
+                finally:
+                    await asyncio.to_thread(file.close)
+
+        content_hash = digest.hexdigest()
+        extension = os.path.splitext(urlparse(media.url).path)[1]
+        local_path = os.path.join(
+            self.directory, content_hash[:2], f"{content_hash}{extension}"
+        )
+        if os.path.exists(local_path):
+            os.remove(partial_path)
+            self.deduplicated += 1
+        else:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            os.replace(partial_path, local_path)
+            self.downloaded += 1
+        logger.info(f"Downloaded media {media.media_id} to {local_path}")
+        return local_path, content_hash
+
+
+def _hash_file(path: str, digest, chunk_size: int):
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            digest.update(chunk)
+
+
+media_downloader = MediaDownloader(
+    Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_DIR,
+    Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_WORKERS,
+    Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_CHUNK_SIZE,
+    Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_TIMEOUT,
+    Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_POLL_INTERVAL,
+    Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_RETRY_AFTER,
+    Secrets.MEDIA_DOWNLOAD.MEDIA_DOWNLOAD_MAX_ATTEMPTS,
+)
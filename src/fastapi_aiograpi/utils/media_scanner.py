@@ -0,0 +1,214 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional, Tuple
+from aiograpi.types import Media
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import update
+from .config_secrets import Secrets
+from ..database.postgresql_handler import async_session_maker
+from ..models.models import MediaScanState
+import logging
+
+logger = logging.getLogger(__name__)
+
+FetchPage = Callable[[str], Awaitable[Tuple[List[Media], str]]]
+
+
+def is_reel(media: Media) -> bool:
+    return media.media_type == 2 and media.product_type == "clips"
+
+
+class MediaScanner:
+    """
+    Counts a user's reels incrementally, keeping progress in the mediascanstate
+    table.
+
+    Each scan fetches at most page_budget pages. It first walks the feed from
+    the top down to the newest media counted before (the watermark), then
+    spends the remaining budget continuing the backfill of older media from the
+    stored cursor. Until the backfill reaches the end of the feed, the count is
+    a lower bound and the scan reports itself incomplete. If the budget runs
+    out before the watermark is reached, the scan restarts from the top.
+    """
+
+    def __init__(self, page_budget: int, lease: float):
+        self.page_budget = page_budget
+        self.lease = lease
+        self.pages = 0
+        self.gaps = 0
+        self.skipped = 0
+        logger.info(f"Initialized MediaScanner (page_budget={page_budget})")
+
+    async def scan(self, user_id: int, fetch_page: FetchPage) -> Tuple[int, bool]:
+        """
+        Returns (reels counted so far, whether the whole feed has been scanned).
+        fetch_page(cursor) returns one page of media, newest first, and the
+        cursor of the next page ("" when there is none).
+
+        The scan claims the user's state row with a lease in one short
+        transaction, fetches pages without holding a database connection, and
+        writes the state back in a second one. If another scan of the user
+        holds the lease, this one reports the stored counts instead.
+        """
+        state = await self._claim(user_id)
+        if state is None:
+            self.skipped += 1
+            async with async_session_maker() as session:
+                state = await session.get(MediaScanState, user_id)
+            return state.reels_count, state.complete
+
+        lease_until = state.lease_until
+        try:
+            pages = await self._advance(user_id, state, fetch_page)
+        except BaseException:
+            # Also when cancelled, e.g. because the user info fetch running
+            # alongside failed; the next scan shouldn't wait out the lease.
+            # Shielded, so a second cancellation can't skip the release.
+            await asyncio.shield(self._release(user_id, lease_until))
+            raise
+        await self._save(state, lease_until)
+        logger.info(
+            f"Scanned {pages} media pages of user {user_id}: {state.reels_count} reels in {state.scanned_count} media"
+        )
+        return state.reels_count, state.complete
+
+    async def _claim(self, user_id: int) -> Optional[MediaScanState]:
+        now = datetime.now(timezone.utc)
+        async with async_session_maker() as session:
+            # The first scans of a user would otherwise race on the insert
+            await session.exec(
+                insert(MediaScanState)
+                .values(
+                    user_id=user_id,
+                    complete=False,
+                    scanned_count=0,
+                    reels_count=0,
+                    updated_at=now,
+                )
+                .on_conflict_do_nothing(index_elements=["user_id"])
+            )
+            statement = (
+                update(MediaScanState)
+                .where(
+                    MediaScanState.user_id == user_id,
+                    (MediaScanState.lease_until.is_(None))
+                    | (MediaScanState.lease_until < now),
+                )
+                .values(lease_until=now + timedelta(seconds=self.lease))
+                .returning(MediaScanState)
+                .execution_options(synchronize_session=False)
+            )
+            state = (await session.exec(statement)).scalars().first()
+            await session.commit()
+            return state
+
+    async def _save(self, state: MediaScanState, lease_until: datetime):
+        async with async_session_maker() as session:
+            result = await session.exec(
+                update(MediaScanState)
+                .where(
+                    MediaScanState.user_id == state.user_id,
+                    MediaScanState.lease_until == lease_until,
+                )
+                .values(
+                    newest_pk=state.newest_pk,
+                    backfill_cursor=state.backfill_cursor,
+                    complete=state.complete,
+                    scanned_count=state.scanned_count,
+                    reels_count=state.reels_count,
+                    updated_at=datetime.now(timezone.utc),
+                    lease_until=None,
+                )
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        if result.rowcount == 0:
+            # The lease expired and another scan took over, so its state wins
+            logger.warning(
+                f"Media scan lease of user {state.user_id} expired, dropping progress"
+            )
+
+    async def _release(self, user_id: int, lease_until: datetime):
+        async with async_session_maker() as session:
+            await session.exec(
+                update(MediaScanState)
+                .where(
+                    MediaScanState.user_id == user_id,
+                    MediaScanState.lease_until == lease_until,
+                )
+                .values(lease_until=None)
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+
+    async def _advance(
+        self, user_id: int, state: MediaScanState, fetch_page: FetchPage
+    ) -> int:
+        """
+        Fetches up to page_budget pages and updates the state in memory.
+        Returns the number of pages fetched.
+        """
+        pages = 0
+
+        if state.newest_pk is not None:
+            newest_pk = state.newest_pk
+            new_scanned = 0
+            new_reels = 0
+            page_scanned = 0
+            page_reels = 0
+            cursor = ""
+            reached_watermark = False
+            while pages < self.page_budget:
+                medias, cursor = await fetch_page(cursor)
+                pages += 1
+                fresh = [media for media in medias if int(media.pk) > state.newest_pk]
+                new_scanned += len(fresh)
+                new_reels += sum(1 for media in fresh if is_reel(media))
+                page_scanned += len(medias)
+                page_reels += sum(1 for media in medias if is_reel(media))
+                newest_pk = max([newest_pk] + [int(media.pk) for media in fresh])
+                # Pinned posts can be older than the watermark, so only the
+                # last item of a page tells whether we're past it
+                if not cursor or not medias or int(medias[-1].pk) <= state.newest_pk:
+                    reached_watermark = True
+                    break
+            self.pages += pages
+
+            if reached_watermark:
+                state.newest_pk = newest_pk
+                state.scanned_count += new_scanned
+                state.reels_count += new_reels
+            else:
+                # Too much new media to bridge to the watermark within the
+                # budget. Continuing would leave a gap, so the pages just
+                # read become the start of a fresh backfill instead.
+                self.gaps += 1
+                logger.warning(
+                    f"Media scan of user {user_id} couldn't reach the watermark, rescanning"
+                )
+                state.newest_pk = newest_pk
+                state.scanned_count = page_scanned
+                state.reels_count = page_reels
+                state.backfill_cursor = cursor
+                state.complete = False
+
+        while not state.complete and pages < self.page_budget:
+            medias, cursor = await fetch_page(state.backfill_cursor or "")
+            pages += 1
+            self.pages += 1
+            if state.newest_pk is None and medias:
+                state.newest_pk = max(int(media.pk) for media in medias)
+            state.scanned_count += len(medias)
+            state.reels_count += sum(1 for media in medias if is_reel(media))
+            state.backfill_cursor = cursor
+            if not cursor or not medias:
+                state.complete = True
+        return pages
+
+    def stats(self) -> dict:
+        return {"pages": self.pages, "gaps": self.gaps, "skipped": self.skipped}
+
+
+media_scanner = MediaScanner(
+    Secrets.MEDIA_SCAN.MEDIA_SCAN_PAGE_BUDGET, Secrets.MEDIA_SCAN.MEDIA_SCAN_LEASE
+)
@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import hmac
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from fastapi import HTTPException
+from .config_secrets import Secrets
+import bcrypt
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt hashing and verification in a bounded thread pool so it doesn't
+    block the event loop.
+
+    At most `workers` bcrypt calls run at once; further calls wait in a queue of
+    at most max_queue entries and are rejected with 503 beyond that. Successful
+    verifications are remembered for cache_ttl seconds, keyed by an HMAC of the
+    username, password and stored hash under a per-process random key, so the
+    plaintext password is never kept in memory.
+    """
+
+    def __init__(self, workers: int, max_queue: int, cache_ttl: float):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.cache_ttl = cache_ttl
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt"
+        )
+        self._semaphore = asyncio.Semaphore(workers)
+        self._cache_key = secrets.token_bytes(32)
+        self._verified: Dict[str, float] = {}
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        logger.info(
+            f"Initialized PasswordHasher (workers={workers}, max_queue={max_queue})"
+        )
+
+    async def hash(self, password: str) -> str:
+        hashed_password = await self._run(
+            bcrypt.hashpw, password.encode(), bcrypt.gensalt()
+        )
+        return hashed_password.decode()
+
+    async def verify(self, username: str, password: str, password_hash: str) -> bool:
+        key = self._credential_key(username, password, password_hash)
+        now = time.monotonic()
+        expires_at = self._verified.get(key)
+        if expires_at is not None and expires_at > now:
+            self.cache_hits += 1
+            return True
+
+        self.cache_misses += 1
+        verified = await self._run(
+            bcrypt.checkpw, password.encode(), password_hash.encode()
+        )
+        if verified:
+            self._remember(key)
+        return verified
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "active": self.active,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait": self.total_wait / self.completed if self.completed else 0.0,
+            "max_wait": self.max_wait,
+            "cache_size": len(self._verified),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _run(self, func, *args):
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            logger.warning("Password hashing queue is full, rejecting request")
+            raise HTTPException(
+                status_code=503,
+                detail="Too many concurrent logins. Please try again later.",
+            )
+
+        queued_at = time.monotonic()
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+
+        wait = time.monotonic() - queued_at
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.active += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def _credential_key(self, username: str, password: str, password_hash: str) -> str:
+        message = "\0".join((username, password, password_hash)).encode()
+        return hmac.new(self._cache_key, message, hashlib.sha256).hexdigest()
+
+    def _remember(self, key: str):
+        now = time.monotonic()
+        if len(self._verified) >= 1024:
+            self._verified = {
+                cached_key: expires_at
+                for cached_key, expires_at in self._verified.items()
+                if expires_at > now
+            }
+        self._verified[key] = now + self.cache_ttl
+
+
+password_hasher = PasswordHasher(
+    Secrets.PASSWORD_HASHER.PASSWORD_HASHER_WORKERS,
+    Secrets.PASSWORD_HASHER.PASSWORD_HASHER_MAX_QUEUE,
+    Secrets.PASSWORD_HASHER.PASSWORD_HASHER_CACHE_TTL,
+)
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .config_secrets import Secrets
+from ..models.models import ProfileStats, ProfileStatsSnapshot
+import sentry_sdk
+import logging
+
+logger = logging.getLogger(__name__)
+
+CachedStats = Tuple[ProfileStats, datetime]
+
+
+class ProfileStatsCache:
+    """
+    Caches ProfileStats responses in an in-memory LRU backed by the
+    profilestatssnapshot table, so restarts and other workers start warm.
+
+    Entries younger than the request's max_age are fresh. Older entries are
+    still served for up to stale_while_revalidate seconds while a background
+    refresh replaces them. Partial entries are fresh for at most
+    partial_max_age seconds, so they are revalidated sooner; for large
+    profiles each revalidation also continues the reels scan.
+    """
+
+    def __init__(
+        self, max_size: int, stale_while_revalidate: int, partial_max_age: int
+    ):
+        self.max_size = max_size
+        self.stale_while_revalidate = stale_while_revalidate
+        self.partial_max_age = partial_max_age
+        self._cache: OrderedDict[str, CachedStats] = OrderedDict()
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        logger.info(
+            f"Initialized ProfileStatsCache (max_size={max_size}, stale_while_revalidate={stale_while_revalidate}s)"
+        )
+
+    async def lookup(
+        self, username: str, session: AsyncSession, max_age: float
+    ) -> Tuple[Optional[CachedStats], str]:
+        """
+        Returns the cached entry and its state: "fresh" (younger than max_age),
+        "stale" (usable while revalidating), "expired" or "miss".
+        """
+        entry = await self._get(username, session)
+        if entry is None:
+            self.misses += 1
+            return None, "miss"
+        age = self.age(entry)
+        max_age = self.max_age(entry, max_age)
+        if age <= max_age:
+            self.hits += 1
+            return entry, "fresh"
+        if age <= max_age + self.stale_while_revalidate:
+            self.stale_hits += 1
+            return entry, "stale"
+        self.misses += 1
+        return entry, "expired"
+
+    async def _get(self, username: str, session: AsyncSession) -> Optional[CachedStats]:
+        key = username.lower()
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+            return entry
+        row = await session.get(ProfileStatsSnapshot, key)
+        if row is None:
+            return None
+        fetched_at = row.fetched_at
+        if fetched_at.tzinfo is None:
+            fetched_at = fetched_at.replace(tzinfo=timezone.utc)
+        entry = (ProfileStats(**row.payload), fetched_at)
+        self._put(key, entry)
+        return entry
+
+    async def put(
+        self, profile_stats: ProfileStats, session: AsyncSession
+    ) -> CachedStats:
+        key = profile_stats.username.lower()
+        fetched_at = datetime.now(timezone.utc)
+        await session.merge(
+            ProfileStatsSnapshot(
+                username=key,
+                payload=profile_stats.model_dump(),
+                fetched_at=fetched_at,
+            )
+        )
+        await session.commit()
+        entry = (profile_stats, fetched_at)
+        self._put(key, entry)
+        return entry
+
+    def refresh_in_background(
+        self, username: str, refresh: Callable[[], Awaitable[None]]
+    ):
+        """
+        Runs refresh() as a background task unless one is already running for
+        the username.
+        """
+        key = username.lower()
+        if key in self._refreshing:
+            return
+
+        async def run():
+            try:
+                await refresh()
+            except Exception as e:
+                logger.warning(f"Background refresh failed for {username}: {str(e)}")
+                sentry_sdk.capture_exception(e)
+            finally:
+                self._refreshing.pop(key, None)
+
+        self._refreshing[key] = asyncio.create_task(run())
+
+    def max_age(self, entry: CachedStats, max_age: float) -> float:
+        """
+        Returns how long the entry is fresh for a request asking for max_age.
+        """
+        if entry[0].partial:
+            return min(max_age, self.partial_max_age)
+        return max_age
+
+    @staticmethod
+    def age(entry: CachedStats) -> float:
+        return (datetime.now(timezone.utc) - entry[1]).total_seconds()
+
+    @staticmethod
+    def etag(profile_stats: ProfileStats) -> str:
+        digest = hashlib.sha1(profile_stats.model_dump_json().encode()).hexdigest()
+        return f'"{digest}"'
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshing": len(self._refreshing),
+        }
+
+    def _put(self, key: str, entry: CachedStats):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+
+profile_stats_cache = ProfileStatsCache(
+    Secrets.PROFILE_STATS_CACHE.PROFILE_STATS_CACHE_SIZE,
+    Secrets.PROFILE_STATS_CACHE.PROFILE_STATS_STALE_WHILE_REVALIDATE,
+    Secrets.PROFILE_STATS_CACHE.PROFILE_STATS_PARTIAL_MAX_AGE,
+)
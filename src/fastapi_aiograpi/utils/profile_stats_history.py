@@ -0,0 +1,138 @@
+from datetime import datetime, timezone
+from typing import List, Optional
+from sqlalchemy import BigInteger, func, literal
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..models.models import ProfileStats, ProfileStatsHistory, ProfileStatsPoint
+import logging
+
+logger = logging.getLogger(__name__)
+
+COUNT_COLUMNS = (
+    "posts_count",
+    "reels_count",
+    "highlights_count",
+    "follower_count",
+    "following_count",
+)
+
+
+class ProfileStatsHistoryStore:
+    """
+    Keeps a time series of profile stats in the profilestatshistory table, one
+    row of integer counts per (user_pk, ts). Counts that weren't complete in a
+    fetch, like the reels of a profile still being scanned, are stored as NULL.
+
+    A fetch only adds a row when a complete count differs from the user's
+    latest row, so polling an unchanged profile doesn't grow the table. A
+    value therefore holds until the next row. Range queries and downsampling
+    run in SQL.
+    """
+
+    def __init__(self):
+        self.recorded = 0
+        self.unchanged = 0
+        logger.info("Initialized ProfileStatsHistoryStore")
+
+    async def record(
+        self,
+        user_pk: int,
+        profile_stats: ProfileStats,
+        session: AsyncSession,
+        reels_complete: bool = True,
+    ):
+        """
+        Adds the complete counts of the stats to the user's history unless
+        they equal the latest row. Doesn't commit.
+        """
+        counts = {column: getattr(profile_stats, column) for column in COUNT_COLUMNS}
+        if not reels_complete:
+            # A running scan's count is only a lower bound
+            counts["reels_count"] = None
+        statement = (
+            select(ProfileStatsHistory)
+            .where(ProfileStatsHistory.user_pk == user_pk)
+            .order_by(ProfileStatsHistory.ts.desc())
+            .limit(1)
+        )
+        latest = (await session.exec(statement)).first()
+        if latest is not None and all(
+            value is None or getattr(latest, column) == value
+            for column, value in counts.items()
+        ):
+            self.unchanged += 1
+            return
+        await session.exec(
+            insert(ProfileStatsHistory)
+            .values(user_pk=user_pk, ts=datetime.now(timezone.utc), **counts)
+            .on_conflict_do_nothing(index_elements=["user_pk", "ts"])
+        )
+        self.recorded += 1
+
+    async def query(
+        self,
+        user_pk: int,
+        session: AsyncSession,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        bucket: Optional[str] = None,
+        agg: str = "max",
+        limit: int = 1000,
+    ) -> List[ProfileStatsPoint]:
+        """
+        Returns the user's rows in [start, end), oldest first. With a bucket,
+        rows are grouped by UTC hour, day, week or month, and each bucket
+        holds the agg of every count: max, min, avg (rounded) or the last
+        value.
+        """
+        ts = ProfileStatsHistory.ts
+        columns = [getattr(ProfileStatsHistory, column) for column in COUNT_COLUMNS]
+        if bucket is None:
+            statement = select(ts, *columns)
+            order = ts
+        else:
+            # Inlined, so the GROUP BY expression matches the selected one
+            bucket_ts = func.date_trunc(
+                literal(bucket, literal_execute=True),
+                ts,
+                literal("UTC", literal_execute=True),
+            ).label("ts")
+            statement = select(
+                bucket_ts, *(_aggregate(column, agg) for column in columns)
+            ).group_by(bucket_ts)
+            order = bucket_ts
+
+        statement = statement.where(ProfileStatsHistory.user_pk == user_pk)
+        if start is not None:
+            statement = statement.where(ts >= start)
+        if end is not None:
+            statement = statement.where(ts < end)
+        statement = statement.order_by(order).limit(limit)
+
+        rows = (await session.exec(statement)).all()
+        return [
+            ProfileStatsPoint(ts=row[0], **dict(zip(COUNT_COLUMNS, row[1:])))
+            for row in rows
+        ]
+
+    def stats(self) -> dict:
+        return {"recorded": self.recorded, "unchanged": self.unchanged}
+
+
+def _aggregate(column, agg: str):
+    if agg == "max":
+        value = func.max(column)
+    elif agg == "min":
+        value = func.min(column)
+    elif agg == "avg":
+        value = func.round(func.avg(column)).cast(BigInteger)
+    else:
+        # The latest complete value in the bucket
+        value = func.array_agg(
+            aggregate_order_by(column, ProfileStatsHistory.ts.desc())
+        ).filter(column.is_not(None))[1]
+    return value.label(column.key)
+
+
+profile_stats_history = ProfileStatsHistoryStore()
@@ -1,5 +1,8 @@
+import asyncio
+import time
 import httpx
-from typing import List
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 from .config_secrets import Secrets
 import sentry_sdk
 import logging
@@ -7,32 +10,95 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class ProxyHealth:
+    latency: Optional[float] = None  # EWMA of successful check latency, seconds
+    error_rate: float = 0.0  # EWMA of failed checks, 0..1
+    checks: int = 0
+    last_checked: Optional[float] = None
+
+    def record(self, success: bool, latency: float, alpha: float):
+        failure = 0.0 if success else 1.0
+        if self.checks == 0:
+            self.error_rate = failure
+        else:
+            self.error_rate = alpha * failure + (1 - alpha) * self.error_rate
+        if success:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = alpha * latency + (1 - alpha) * self.latency
+        self.checks += 1
+        self.last_checked = time.monotonic()
+
+
 class ProxyManager:
-    def __init__(self, proxy_ips: List[str]):
-        self.proxy_ips = proxy_ips
-        logger.info(f"Initialized ProxyManager with {len(proxy_ips)} proxies")
+    def __init__(
+        self,
+        proxy_ips: List[str],
+        check_concurrency: int,
+        check_timeout: float,
+        monitor_interval: float,
+        ewma_alpha: float,
+        max_error_rate: float,
+    ):
+        self.proxy_ips = [proxy for proxy in proxy_ips if proxy]
+        self.check_timeout = check_timeout
+        self.monitor_interval = monitor_interval
+        self.ewma_alpha = ewma_alpha
+        self.max_error_rate = max_error_rate
+        self.health: Dict[str, ProxyHealth] = {
+            proxy: ProxyHealth() for proxy in self.proxy_ips
+        }
+        self._check_semaphore = asyncio.Semaphore(check_concurrency)
+        self._http_clients: Dict[str, httpx.AsyncClient] = {}
+        self._monitor_task: Optional[asyncio.Task] = None
+        logger.info(f"Initialized ProxyManager with {len(self.proxy_ips)} proxies")
 
-    async def check_proxy(self, proxy: str) -> bool:
-        try:
+    def _get_http_client(self, proxy: str) -> httpx.AsyncClient:
+        """
+        Returns the shared httpx client for a proxy, so repeated checks reuse
+        pooled connections instead of opening a new client every time.
+        """
+        client = self._http_clients.get(proxy)
+        if client is None or client.is_closed:
             proxy_url = (
                 f"http://{proxy}"  # Ensure the scheme matches the Squid configuration
             )
-            async with httpx.AsyncClient(
-                proxies={"http://": proxy_url}, timeout=10, verify=False
-            ) as client:
-                response = await client.get(
-                    "https://www.instagram.com", follow_redirects=True
-                )
-                success = response.status_code < 400
-                logger.info(
-                    f"Proxy check: {'success' if success else 'fail'} for {proxy_url}. Status: {response.status_code}"
-                )
-                sentry_sdk.add_breadcrumb(
-                    category="proxy",
-                    message=f"Proxy check: {'success' if success else 'fail'}",
-                    data={"proxy": proxy_url, "status": response.status_code},
-                )
-                return success
+            client = httpx.AsyncClient(
+                proxies={"http://": proxy_url, "https://": proxy_url},
+                timeout=self.check_timeout,
+                verify=False,
+                limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+            )
+            self._http_clients[proxy] = client
+        return client
+
+    async def check_proxy(self, proxy: str) -> bool:
+        started = time.monotonic()
+        success = await self._probe(proxy)
+        self.health.setdefault(proxy, ProxyHealth()).record(
+            success, time.monotonic() - started, self.ewma_alpha
+        )
+        return success
+
+    async def _probe(self, proxy: str) -> bool:
+        proxy_url = f"http://{proxy}"
+        try:
+            client = self._get_http_client(proxy)
+            response = await client.get(
+                "https://www.instagram.com", follow_redirects=True
+            )
+            success = response.status_code < 400
+            logger.info(
+                f"Proxy check: {'success' if success else 'fail'} for {proxy_url}. Status: {response.status_code}"
+            )
+            sentry_sdk.add_breadcrumb(
+                category="proxy",
+                message=f"Proxy check: {'success' if success else 'fail'}",
+                data={"proxy": proxy_url, "status": response.status_code},
+            )
+            return success
         except httpx.TimeoutException:
             logger.error(f"Proxy check timed out for {proxy}")
             return False
@@ -47,21 +113,71 @@ class ProxyManager:
             )
             return False
 
+    async def _bounded_check(self, proxy: str) -> Tuple[str, bool]:
+        async with self._check_semaphore:
+            return proxy, await self.check_proxy(proxy)
+
+    def is_healthy(self, proxy: str) -> bool:
+        health = self.health.get(proxy)
+        return (
+            health is not None
+            and health.checks > 0
+            and health.error_rate <= self.max_error_rate
+        )
+
+    def is_degraded(self, proxy: str) -> bool:
+        """
+        Returns True only for proxies the monitor has checked and found bad.
+        Proxies that haven't been checked yet are not considered degraded.
+        """
+        health = self.health.get(proxy)
+        return (
+            health is not None
+            and health.checks > 0
+            and health.error_rate > self.max_error_rate
+        )
+
+    def ranked_proxies(self) -> List[str]:
+        """
+        Returns healthy proxies, fastest first, based on the monitor's EWMAs.
+        """
+        healthy = [proxy for proxy in self.proxy_ips if self.is_healthy(proxy)]
+        return sorted(
+            healthy,
+            key=lambda proxy: (
+                self.health[proxy].error_rate,
+                self.health[proxy].latency or float("inf"),
+            ),
+        )
+
     async def get_working_proxy(self) -> str:
         """
-        Returns a working proxy from the list, checking its validity.
-        If no working proxies are found, raises an exception.
+        Returns the fastest healthy proxy known to the health monitor. If the
+        monitor hasn't found one yet, checks proxies concurrently and returns the
+        first one that passes. If no working proxies are found, raises an exception.
         """
+        ranked = self.ranked_proxies()
+        if ranked:
+            return ranked[0]
+
         logger.info("Attempting to get a working proxy")
-        for proxy in self.proxy_ips:
-            if await self.check_proxy(proxy):
-                logger.info(f"Working proxy found: {proxy}")
-                sentry_sdk.add_breadcrumb(
-                    category="proxy",
-                    message="Working proxy found",
-                    data={"proxy": proxy},
-                )
-                return proxy
+        tasks = [
+            asyncio.create_task(self._bounded_check(proxy)) for proxy in self.proxy_ips
+        ]
+        try:
+            for next_check in asyncio.as_completed(tasks):
+                proxy, working = await next_check
+                if working:
+                    logger.info(f"Working proxy found: {proxy}")
+                    sentry_sdk.add_breadcrumb(
+                        category="proxy",
+                        message="Working proxy found",
+                        data={"proxy": proxy},
+                    )
+                    return proxy
+        finally:
+            for task in tasks:
+                task.cancel()
         logger.error("No working proxies available")
         sentry_sdk.add_breadcrumb(
             category="proxy",
@@ -70,6 +186,61 @@ class ProxyManager:
         )
         raise Exception("No working proxies available")
 
+    async def check_all(self):
+        await asyncio.gather(*(self._bounded_check(proxy) for proxy in self.proxy_ips))
+        logger.info(
+            f"Proxy health check finished: {len(self.ranked_proxies())}/{len(self.proxy_ips)} healthy"
+        )
+
+    async def _monitor(self):
+        while True:
+            try:
+                await self.check_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Proxy health monitor failed: {e}")
+                sentry_sdk.capture_exception(e)
+            await asyncio.sleep(self.monitor_interval)
+
+    def start_monitor(self):
+        if self._monitor_task is None and self.proxy_ips:
+            self._monitor_task = asyncio.create_task(self._monitor())
+            logger.info(
+                f"Started proxy health monitor (interval={self.monitor_interval}s)"
+            )
+
+    def stats(self) -> dict:
+        return {
+            proxy: {
+                "healthy": self.is_healthy(proxy),
+                "latency": health.latency,
+                "error_rate": health.error_rate,
+                "checks": health.checks,
+            }
+            for proxy, health in self.health.items()
+        }
+
+    async def aclose(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            try:
+                await self._monitor_task
+            except asyncio.CancelledError:
+                pass
+            self._monitor_task = None
+        clients = list(self._http_clients.values())
+        self._http_clients.clear()
+        for client in clients:
+            await client.aclose()
+
 
-proxy_manager = ProxyManager(Secrets.PROXY.PROXY_IPS)
+proxy_manager = ProxyManager(
+    Secrets.PROXY.PROXY_IPS,
+    Secrets.PROXY.PROXY_CHECK_CONCURRENCY,
+    Secrets.PROXY.PROXY_CHECK_TIMEOUT,
+    Secrets.PROXY.PROXY_MONITOR_INTERVAL,
+    Secrets.PROXY.PROXY_EWMA_ALPHA,
+    Secrets.PROXY.PROXY_MAX_ERROR_RATE,
+)
 logger.info(f"ProxyManager initialized with {len(proxy_manager.proxy_ips)} proxies")
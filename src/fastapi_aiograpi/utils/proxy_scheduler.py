@@ -0,0 +1,141 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Set
+from fastapi import HTTPException
+from .config_secrets import Secrets
+from .proxy_manager import ProxyManager, proxy_manager
+import sentry_sdk
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProxyLoad:
+    accounts: Set[str] = field(default_factory=set)
+    in_flight: int = 0
+    waiting: int = 0
+    acquired: int = 0
+    timeouts: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+
+class ProxyScheduler:
+    """
+    Spreads accounts and requests across proxies.
+
+    Each proxy allows at most max_concurrency in-flight requests; further
+    requests wait up to slot_timeout seconds for a slot and fail with 503 after
+    that. New accounts go to the healthy proxy with the fewest accounts, then
+    the least in-flight work, then the best latency rank.
+    """
+
+    def __init__(
+        self, manager: ProxyManager, max_concurrency: int, slot_timeout: float
+    ):
+        self.manager = manager
+        self.max_concurrency = max_concurrency
+        self.slot_timeout = slot_timeout
+        self._loads: Dict[str, ProxyLoad] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._account_proxy: Dict[str, str] = {}
+        logger.info(
+            f"Initialized ProxyScheduler (max_concurrency={max_concurrency} per proxy)"
+        )
+
+    def _load(self, proxy: str) -> ProxyLoad:
+        return self._loads.setdefault(proxy, ProxyLoad())
+
+    def register_account(self, username: str, proxy: str):
+        previous = self._account_proxy.get(username)
+        if previous == proxy:
+            return
+        if previous is not None:
+            self._load(previous).accounts.discard(username)
+        self._account_proxy[username] = proxy
+        self._load(proxy).accounts.add(username)
+
+    def register_accounts(self, account_proxies: Dict[str, str]):
+        for username, proxy in account_proxies.items():
+            self.register_account(username, proxy)
+        logger.info(f"Registered {len(account_proxies)} accounts with proxies")
+
+    async def assign_proxy(self, username: str) -> str:
+        """
+        Picks the least loaded healthy proxy for an account and registers it.
+        """
+        ranked = self.manager.ranked_proxies()
+        if ranked:
+            rank = {proxy: index for index, proxy in enumerate(ranked)}
+            proxy = min(
+                ranked,
+                key=lambda proxy: (
+                    len(self._load(proxy).accounts),
+                    self._load(proxy).in_flight + self._load(proxy).waiting,
+                    rank[proxy],
+                ),
+            )
+        else:
+            proxy = await self.manager.get_working_proxy()
+        self.register_account(username, proxy)
+        sentry_sdk.add_breadcrumb(
+            category="proxy",
+            message="Proxy assigned",
+            data={"username": username, "proxy": proxy},
+        )
+        return proxy
+
+    async def acquire(self, proxy: str):
+        """
+        Waits for a request slot on the proxy.
+        """
+        load = self._load(proxy)
+        semaphore = self._semaphores.setdefault(
+            proxy, asyncio.Semaphore(self.max_concurrency)
+        )
+        queued_at = time.monotonic()
+        load.waiting += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.slot_timeout)
+        except asyncio.TimeoutError:
+            load.timeouts += 1
+            logger.warning(f"Timed out waiting for a request slot on proxy {proxy}")
+            raise HTTPException(
+                status_code=503,
+                detail="Proxy is busy. Please try again later.",
+            )
+        finally:
+            load.waiting -= 1
+
+        wait = time.monotonic() - queued_at
+        load.total_wait += wait
+        load.max_wait = max(load.max_wait, wait)
+        load.acquired += 1
+        load.in_flight += 1
+
+    def release(self, proxy: str):
+        self._load(proxy).in_flight -= 1
+        self._semaphores[proxy].release()
+
+    def stats(self) -> dict:
+        return {
+            proxy: {
+                "accounts": len(load.accounts),
+                "in_flight": load.in_flight,
+                "waiting": load.waiting,
+                "acquired": load.acquired,
+                "timeouts": load.timeouts,
+                "avg_wait": load.total_wait / load.acquired if load.acquired else 0.0,
+                "max_wait": load.max_wait,
+            }
+            for proxy, load in self._loads.items()
+        }
+
+
+proxy_scheduler = ProxyScheduler(
+    proxy_manager,
+    Secrets.PROXY.PROXY_MAX_CONCURRENCY,
+    Secrets.PROXY.PROXY_SLOT_TIMEOUT,
+)
@@ -1,23 +1,295 @@
-from fastapi import HTTPException
-from datetime import datetime, timedelta
+import asyncio
+import math
+import time
 from collections import defaultdict
+from typing import Dict, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert
+from .config_secrets import Secrets
+from ..database.postgresql_handler import engine
+from ..models.models import RateLimitCounter
+import sentry_sdk
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SlidingWindow:
+    """
+    Sliding-window counter: the request count of the current and the previous
+    fixed window, with the previous one weighted by how much of it still
+    overlaps the sliding window. Constant memory per key.
+    """
+
+    __slots__ = ("window_start", "previous", "current")
+
+    def __init__(self, now: float):
+        self.window_start = now
+        self.previous = 0
+        self.current = 0
+
+    def advance(self, now: float, window: float):
+        elapsed = int((now - self.window_start) // window)
+        if elapsed == 1:
+            self.previous = self.current
+            self.current = 0
+            self.window_start += window
+        elif elapsed > 1:
+            self.previous = 0
+            self.current = 0
+            self.window_start += elapsed * window
+
+    def estimate(self, now: float, window: float) -> float:
+        overlap = 1 - (now - self.window_start) / window
+        return self.previous * overlap + self.current
+
+
+class LocalBackend:
+    """
+    Keeps counters in process memory. Limits are per worker process.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._windows: Dict[str, SlidingWindow] = {}
+
+    def estimate(self, key: str) -> Tuple[float, float]:
+        """
+        Returns (estimated requests in the sliding window, seconds until the
+        current fixed window ends).
+        """
+        now = time.monotonic()
+        counter = self._windows.get(key)
+        if counter is None:
+            counter = self._windows[key] = SlidingWindow(now)
+        counter.advance(now, self.window)
+        return (
+            counter.estimate(now, self.window),
+            counter.window_start + self.window - now,
+        )
+
+    def hit(self, key: str):
+        self._windows[key].current += 1
+
+    def forget(self, key: str):
+        self._windows.pop(key, None)
+
+    def start(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+class PostgresBackend:
+    """
+    Shares counters across worker processes through the ratelimitcounter table.
+
+    Checks never wait on the database: they combine the totals read on the last
+    flush with hits this process hasn't flushed yet. Every flush_interval
+    seconds the pending hits are written with one batched upsert, and fresh
+    totals for all active keys are read back in the same transaction. If the
+    database is unavailable, limits keep working from the local counts and the
+    pending hits are retried on the next flush.
+
+    Windows are aligned on wall-clock time so all workers agree on them.
+    """
+
+    def __init__(self, window: float, flush_interval: float):
+        self.window = window
+        self.flush_interval = flush_interval
+        self._totals: Dict[Tuple[str, int], int] = {}
+        self._pending: Dict[Tuple[str, int], int] = defaultdict(int)
+        # Hits being written by the running flush, counted until the totals
+        # that include them are read back
+        self._flushing: Dict[Tuple[str, int], int] = {}
+        self._active = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def _count(self, key: str, window_index: int) -> int:
+        return (
+            self._totals.get((key, window_index), 0)
+            + self._flushing.get((key, window_index), 0)
+            + self._pending.get((key, window_index), 0)
+        )
+
+    def estimate(self, key: str) -> Tuple[float, float]:
+        now = time.time()
+        window_index = int(now // self.window)
+        self._active.add(key)
+        overlap = 1 - (now - window_index * self.window) / self.window
+        estimate = self._count(key, window_index - 1) * overlap + self._count(
+            key, window_index
+        )
+        return estimate, (window_index + 1) * self.window - now
+
+    def hit(self, key: str):
+        self._pending[(key, int(time.time() // self.window))] += 1
+
+    def forget(self, key: str):
+        self._active.discard(key)
+
+    async def flush(self):
+        pending, self._pending = self._pending, defaultdict(int)
+        self._flushing = pending
+        window_index = int(time.time() // self.window)
+        keys = list(self._active)
+        try:
+            async with engine.begin() as conn:
+                if pending:
+                    statement = insert(RateLimitCounter).values(
+                        [
+                            {"key": key, "window_index": index, "count": count}
+                            for (key, index), count in pending.items()
+                        ]
+                    )
+                    statement = statement.on_conflict_do_update(
+                        index_elements=["key", "window_index"],
+                        set_={
+                            "count": RateLimitCounter.count + statement.excluded.count
+                        },
+                    )
+                    await conn.execute(statement)
+                totals = {}
+                if keys:
+                    result = await conn.execute(
+                        select(
+                            RateLimitCounter.key,
+                            RateLimitCounter.window_index,
+                            RateLimitCounter.count,
+                        ).where(
+                            RateLimitCounter.key.in_(keys),
+                            RateLimitCounter.window_index >= window_index - 1,
+                        )
+                    )
+                    totals = {(key, index): count for key, index, count in result}
+                if self.flushes % 100 == 0:
+                    await conn.execute(
+                        delete(RateLimitCounter).where(
+                            RateLimitCounter.window_index < window_index - 1
+                        )
+                    )
+            self._totals = totals
+            self.flushes += 1
+        except Exception as e:
+            # Keep the hits that still matter for the next successful flush
+            for (key, index), count in pending.items():
+                if index >= window_index - 1:
+                    self._pending[(key, index)] += count
+            self.flush_errors += 1
+            logger.error(f"Rate limit flush failed: {str(e)}")
+            sentry_sdk.capture_exception(e)
+        finally:
+            self._flushing = {}
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+            logger.info(f"Started rate limit flusher (interval={self.flush_interval}s)")
+
+    async def aclose(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
 
 
 class RateLimiter:
-    def __init__(self, requests_per_minute: int = 5):
+    """
+    Per-route, per-account rate limiter.
+
+    Limits are requests per window (one minute by default). The limit for a
+    request is the account override if there is one, else the route override,
+    else requests_per_minute. Keys that haven't been seen for idle_ttl seconds
+    are evicted periodically. Counters live in the given backend, in process
+    memory by default.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: int = 5,
+        route_limits: Optional[Dict[str, int]] = None,
+        account_limits: Optional[Dict[str, int]] = None,
+        idle_ttl: float = 600,
+        window: float = 60,
+        backend=None,
+    ):
         self.requests_per_minute = requests_per_minute
-        self.user_requests = defaultdict(list)
+        self.route_limits = route_limits or {}
+        self.account_limits = account_limits or {}
+        self.idle_ttl = idle_ttl
+        self.window = window
+        self.backend = backend or LocalBackend(window)
+        self._last_seen: Dict[str, float] = {}
+        self._last_sweep = time.monotonic()
+
+    def limit_for(self, username: str, route: str) -> int:
+        if username in self.account_limits:
+            return self.account_limits[username]
+        return self.route_limits.get(route, self.requests_per_minute)
+
+    def check_rate_limit(self, username: str, route: str = "default"):
+        now = time.monotonic()
+        self._sweep(now)
+
+        key = f"{route}:{username}"
+        self._last_seen[key] = now
+        estimate, window_remaining = self.backend.estimate(key)
+
+        if estimate >= self.limit_for(username, route):
+            raise HTTPException(
+                status_code=429,
+                detail="Rate limit exceeded",
+                headers={"Retry-After": str(max(math.ceil(window_remaining), 1))},
+            )
+
+        self.backend.hit(key)
+
+    def start(self):
+        self.backend.start()
+
+    async def aclose(self):
+        await self.backend.aclose()
+
+    def _sweep(self, now: float):
+        if now - self._last_sweep < self.idle_ttl:
+            return
+        self._last_sweep = now
+        idle = [
+            key
+            for key, last_seen in self._last_seen.items()
+            if now - last_seen >= self.idle_ttl
+        ]
+        for key in idle:
+            del self._last_seen[key]
+            self.backend.forget(key)
 
-    def check_rate_limit(self, username: str):
-        now = datetime.now()
-        user_reqs = self.user_requests[username]
-        user_reqs = [req for req in user_reqs if now - req < timedelta(minutes=1)]
-        self.user_requests[username] = user_reqs
+    def __len__(self) -> int:
+        return len(self._last_seen)
 
-        if len(user_reqs) >= self.requests_per_minute:
-            raise HTTPException(status_code=429, detail="Rate limit exceeded")
 
-        self.user_requests[username].append(now)
+def _create_backend(name: str, window: float = 60):
+    if name == "postgres":
+        return PostgresBackend(window, Secrets.RATE_LIMIT.RATE_LIMIT_FLUSH_INTERVAL)
+    return LocalBackend(window)
 
 
-rate_limiter = RateLimiter()
+rate_limiter = RateLimiter(
+    Secrets.RATE_LIMIT.RATE_LIMIT_PER_MINUTE,
+    Secrets.RATE_LIMIT.RATE_LIMIT_ROUTES,
+    Secrets.RATE_LIMIT.RATE_LIMIT_ACCOUNTS,
+    Secrets.RATE_LIMIT.RATE_LIMIT_IDLE_TTL,
+    backend=_create_backend(Secrets.RATE_LIMIT.RATE_LIMIT_BACKEND),
+)
@@ -0,0 +1,303 @@
+import asyncio
+import math
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from aiograpi.exceptions import (
+    ClientConnectionError,
+    ClientIncompleteReadError,
+    ClientRequestTimeout,
+    ClientThrottledError,
+    FeedbackRequired,
+    PleaseWaitFewMinutes,
+    ProxyAddressIsBlocked,
+    ProxyError,
+    RateLimitError,
+    SentryBlock,
+)
+from fastapi import HTTPException
+from .config_secrets import Secrets
+from .session_manager import canonical_proxy
+import sentry_sdk
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Failure kinds, see classify()
+THROTTLED = "throttled"
+BLOCKED = "blocked"
+PROXY = "proxy"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+BreakerKey = Tuple[str, str]
+
+
+def classify(exc: Exception) -> str:
+    """
+    Sorts an upstream exception into a failure kind:
+
+    - throttled: Instagram asks the account to slow down
+    - blocked: the account's actions are blocked, retrying makes it worse
+    - proxy: the proxy refused or is blocked
+    - transient: connection problems and timeouts, worth retrying
+    - fatal: everything else (not found, private, login required, ...)
+    """
+    if isinstance(exc, (PleaseWaitFewMinutes, RateLimitError, ClientThrottledError)):
+        return THROTTLED
+    if isinstance(exc, (FeedbackRequired, SentryBlock)):
+        return BLOCKED
+    if isinstance(exc, (ProxyError, ProxyAddressIsBlocked)):
+        return PROXY
+    if isinstance(
+        exc,
+        (
+            ClientConnectionError,
+            ClientRequestTimeout,
+            ClientIncompleteReadError,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return TRANSIENT
+    return FATAL
+
+
+def retry_after(exc: Exception) -> Optional[float]:
+    """
+    Returns the delay in seconds the server asked for in a Retry-After header,
+    if the exception carries a response with one.
+    """
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def account_key(username: str) -> BreakerKey:
+    return ("account", username)
+
+
+def proxy_key(proxy: str) -> BreakerKey:
+    # Clients carry their proxy with a scheme, stored proxies don't
+    return ("proxy", canonical_proxy(proxy))
+
+
+@dataclass
+class BreakerState:
+    failures: int = 0
+    open_until: float = 0.0
+    trips: int = 0
+    probing: bool = False
+
+
+class CircuitBreaker:
+    """
+    Per-account and per-proxy circuit breakers.
+
+    A breaker opens after failure_threshold consecutive failures, or right away
+    when Instagram throttles or blocks the account. While open, calls fail fast
+    with 503 and a Retry-After header. The cooldown is cooldown seconds,
+    doubling with every consecutive trip up to max_cooldown, or the server's
+    Retry-After hint if that is longer. After the cooldown a single probe call is let
+    through; its outcome closes or reopens the breaker.
+    """
+
+    def __init__(self, failure_threshold: int, cooldown: float, max_cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._states: Dict[BreakerKey, BreakerState] = {}
+        self.rejected = 0
+        logger.info(
+            f"Initialized CircuitBreaker (failure_threshold={failure_threshold}, cooldown={cooldown}s)"
+        )
+
+    def is_open(self, key: BreakerKey) -> bool:
+        state = self._states.get(key)
+        return state is not None and state.open_until > time.monotonic()
+
+    def check(self, key: BreakerKey):
+        """
+        Raises 503 if the breaker is open, or half-open with a probe already
+        running. Otherwise lets the call through, as the probe if half-open.
+        """
+        state = self._states.get(key)
+        if state is None or not state.open_until:
+            return
+        remaining = state.open_until - time.monotonic()
+        if remaining <= 0 and not state.probing:
+            state.probing = True
+            return
+        self._reject(key, remaining)
+
+    def check_open(self, key: BreakerKey):
+        """
+        Raises 503 while the breaker is open. Unlike check(), this never
+        claims the half-open probe, so it is safe for fail-fast checks that
+        aren't followed by an upstream call of their own.
+        """
+        if self.is_open(key):
+            self._reject(key, self.remaining(key))
+
+    def _reject(self, key: BreakerKey, remaining: float):
+        self.rejected += 1
+        raise HTTPException(
+            status_code=503,
+            detail=f"Upstream is unavailable for this {key[0]}. Please try again later.",
+            headers={"Retry-After": str(max(math.ceil(remaining), 1))},
+        )
+
+    def remaining(self, key: BreakerKey) -> float:
+        state = self._states.get(key)
+        if state is None:
+            return 0.0
+        return max(state.open_until - time.monotonic(), 0.0)
+
+    def record_success(self, key: BreakerKey):
+        self._states.pop(key, None)
+
+    def abandon_probe(self, key: BreakerKey):
+        state = self._states.get(key)
+        if state is not None:
+            state.probing = False
+
+    def record_failure(self, key: BreakerKey, kind: str, hint: Optional[float] = None):
+        state = self._states.setdefault(key, BreakerState())
+        state.failures += 1
+        if kind in (THROTTLED, BLOCKED) or state.probing:
+            self._trip(key, state, hint)
+        elif state.failures >= self.failure_threshold:
+            self._trip(key, state, hint)
+
+    def _trip(self, key: BreakerKey, state: BreakerState, hint: Optional[float]):
+        cooldown = max(
+            hint or 0.0, min(self.cooldown * 2**state.trips, self.max_cooldown)
+        )
+        state.open_until = time.monotonic() + cooldown
+        state.trips += 1
+        state.failures = 0
+        state.probing = False
+        logger.warning(f"Circuit breaker for {key[0]} {key[1]} opened for {cooldown}s")
+        sentry_sdk.add_breadcrumb(
+            category="resilience",
+            message="Circuit breaker opened",
+            data={"kind": key[0], "key": key[1], "cooldown": cooldown},
+        )
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "rejected": self.rejected,
+            "open": {
+                f"{kind}:{name}": math.ceil(state.open_until - now)
+                for (kind, name), state in self._states.items()
+                if state.open_until > now
+            },
+        }
+
+
+circuit_breaker = CircuitBreaker(
+    Secrets.RESILIENCE.BREAKER_FAILURE_THRESHOLD,
+    Secrets.RESILIENCE.BREAKER_COOLDOWN,
+    Secrets.RESILIENCE.BREAKER_MAX_COOLDOWN,
+)
+
+
+async def call_upstream(
+    fn: Callable[[], Awaitable[Any]],
+    account: str,
+    proxy: Optional[str] = None,
+    max_attempts: int = Secrets.RESILIENCE.RETRY_MAX_ATTEMPTS,
+    base_delay: float = Secrets.RESILIENCE.RETRY_BASE_DELAY,
+    max_delay: float = Secrets.RESILIENCE.RETRY_MAX_DELAY,
+) -> Any:
+    """
+    Calls fn() behind the account's and the proxy's circuit breakers.
+
+    Only transient and proxy failures are retried, with full-jitter
+    exponential backoff capped at max_delay, or after the server's Retry-After
+    if that fits within max_delay. Throttling and action blocks open the
+    account's breaker and fail with 503 right away, so the request doesn't
+    wait minutes for an answer the breaker already knows. Fatal errors are
+    raised unchanged.
+    """
+    keys = [account_key(account)]
+    if proxy:
+        keys.append(proxy_key(proxy))
+
+    attempt = 0
+    while True:
+        checked = []
+        try:
+            for key in keys:
+                circuit_breaker.check(key)
+                checked.append(key)
+        except HTTPException:
+            # Release a probe claimed by an earlier key
+            for key in checked:
+                circuit_breaker.abandon_probe(key)
+            raise
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            for key in keys:
+                circuit_breaker.abandon_probe(key)
+            raise
+        except Exception as e:
+            kind = classify(e)
+            if kind == FATAL:
+                # Instagram answered, so the account and proxy are reachable
+                for key in keys:
+                    circuit_breaker.record_success(key)
+                raise
+            hint = retry_after(e)
+            key = keys[-1] if kind in (PROXY, TRANSIENT) else keys[0]
+            circuit_breaker.record_failure(key, kind, hint)
+            # The other keys weren't at fault, but any probe they claimed for
+            # this attempt is over
+            for other in checked:
+                if other != key:
+                    circuit_breaker.abandon_probe(other)
+            attempt += 1
+
+            retryable = kind in (PROXY, TRANSIENT) and attempt < max_attempts
+            delay = (
+                hint
+                if hint is not None
+                else random.uniform(0, min(max_delay, base_delay * 2**attempt))
+            )
+            if not retryable or delay > max_delay:
+                logger.warning(f"Upstream call for {account} failed ({kind}): {e}")
+                sentry_sdk.capture_exception(e)
+                retry_in = max(hint or 0.0, circuit_breaker.remaining(key))
+                raise HTTPException(
+                    status_code=503,
+                    detail="Instagram is unavailable for this account right now. Please try again later.",
+                    headers={"Retry-After": str(max(math.ceil(retry_in), 1))},
+                ) from e
+
+            logger.warning(
+                f"Upstream call for {account} failed ({kind}), retrying in {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+            continue
+
+        for key in keys:
+            circuit_breaker.record_success(key)
+        return result
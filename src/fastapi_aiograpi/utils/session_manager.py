@@ -1,70 +1,198 @@
-from typing import Optional
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
 import logging
-from sqlmodel import Session, select
+from sqlalchemy import func
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .config_secrets import Secrets
+from .password_hasher import password_hasher
 from ..models.models import User
-import bcrypt
 
 logger = logging.getLogger(__name__)
 
 
+def canonical_proxy(proxy: Optional[str]) -> Optional[str]:
+    """
+    Returns the proxy as host:port. aiograpi clients report their proxy with a
+    scheme, while the scheduler and proxy health are keyed without one.
+    """
+    if not proxy:
+        return proxy
+    return proxy.split("://", 1)[-1]
+
+
+@dataclass
+class CachedUser:
+    session: Optional[dict]
+    proxy: Optional[str]
+    password_hash: Optional[str]
+    loaded_at: float = field(default_factory=time.monotonic)
+
+    @classmethod
+    def from_user(cls, user: User) -> "CachedUser":
+        # Rows saved by older versions may carry a scheme
+        return cls(
+            session=user.session,
+            proxy=canonical_proxy(user.proxy),
+            password_hash=user.password,
+        )
+
+
+class UserCache:
+    """
+    Process-wide write-through cache of User rows, keyed by username.
+
+    It is warmed from the database at startup and updated in place whenever
+    SessionStore writes a user, so most reads on the request path don't touch
+    the database. Other worker processes write the same table, so users are
+    read again once they have been cached for ttl seconds; a login, logout,
+    password change or proxy reassignment in another process is seen within
+    that time. Usernames that aren't in the database are remembered for
+    negative_ttl seconds to avoid repeated lookups.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._users: Dict[str, CachedUser] = {}
+        self._missing: Dict[str, float] = {}
+
+    def lookup(self, username: str) -> Tuple[bool, Optional[CachedUser]]:
+        """
+        Returns (found, user). found is False if the database has to be asked.
+        """
+        user = self._users.get(username)
+        if user is not None:
+            if time.monotonic() - user.loaded_at < self.ttl:
+                return True, user
+            del self._users[username]
+        missing_since = self._missing.get(username)
+        if missing_since is not None:
+            if time.monotonic() - missing_since < self.negative_ttl:
+                return True, None
+            del self._missing[username]
+        return False, None
+
+    def put(self, username: str, user: Optional[CachedUser]):
+        if user is None:
+            self._users.pop(username, None)
+            self._missing[username] = time.monotonic()
+        else:
+            self._missing.pop(username, None)
+            self._users[username] = user
+
+    def warm(self, users):
+        for user in users:
+            self.put(user.username, CachedUser.from_user(user))
+        logger.info(f"User cache warmed with {len(self._users)} users")
+
+    def proxies(self) -> Dict[str, str]:
+        return {
+            username: user.proxy for username, user in self._users.items() if user.proxy
+        }
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+
+user_cache = UserCache(
+    Secrets.USER_CACHE.USER_CACHE_TTL, Secrets.USER_CACHE.USER_CACHE_NEGATIVE_TTL
+)
+
+
 class SessionStore:
-    def __init__(self, session: Session):
+    def __init__(self, session: AsyncSession):
         self.session = session
 
-    def load_sessions(self):
+    async def load_sessions(self):
         statement = select(User)
-        users = self.session.exec(statement).all()
-        self.sessions = {user.username: user.session for user in users}
-        self.user_proxy_map = {user.username: user.proxy for user in users}
-        self.passwords = {user.username: user.password for user in users}
+        users = (await self.session.exec(statement)).all()
+        user_cache.warm(users)
+
+    async def _get_user(self, username: str) -> Optional[User]:
+        statement = select(User).where(User.username == username)
+        return (await self.session.exec(statement)).first()
+
+    async def _get_cached_user(self, username: str) -> Optional[CachedUser]:
+        found, cached = user_cache.lookup(username)
+        if found:
+            return cached
+        user = await self._get_user(username)
+        cached = CachedUser.from_user(user) if user else None
+        user_cache.put(username, cached)
+        return cached
+
+    async def _write_user(self, user: User):
+        self.session.add(user)
+        await self.session.commit()
+        user_cache.put(user.username, CachedUser.from_user(user))
 
-    def save_session(
+    async def save_session(
         self,
         username: str,
         session_data: dict,
         proxy: str,
         password: Optional[str] = None,
     ):
-        user = self.session.exec(select(User).where(User.username == username)).first()
+        proxy = canonical_proxy(proxy)
+        user = await self._get_user(username)
         if user:
             user.session = session_data
             user.proxy = proxy
             if password:
-                hashed_password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
-                user.password = hashed_password.decode()
+                user.password = await password_hasher.hash(password)
         else:
-            hashed_password = (
-                bcrypt.hashpw(password.encode(), bcrypt.gensalt()) if password else None
-            )
             user = User(
                 username=username,
                 session=session_data,
                 proxy=proxy,
-                password=hashed_password.decode() if hashed_password else None,
+                password=await password_hasher.hash(password) if password else None,
             )
-            self.session.add(user)
-        self.session.commit()
+        await self._write_user(user)
+
+    async def assign_proxy(self, username: str, proxy: str):
+        proxy = canonical_proxy(proxy)
+        user = await self._get_user(username)
+        if user:
+            user.proxy = proxy
+        else:
+            user = User(username=username, session=None, proxy=proxy, password=None)
+        await self._write_user(user)
 
-    def get_session(self, username: str) -> Optional[dict]:
-        user = self.session.exec(select(User).where(User.username == username)).first()
+    async def get_session(self, username: str) -> Optional[dict]:
+        user = await self._get_cached_user(username)
         if user:
             return user.session
         return None
 
-    def get_password_hash(self, username: str) -> Optional[str]:
-        user = self.session.exec(select(User).where(User.username == username)).first()
+    async def get_password_hash(self, username: str) -> Optional[str]:
+        user = await self._get_cached_user(username)
         if user:
-            return user.password
+            return user.password_hash
         return None
 
-    def verify_password(self, username: str, password: str) -> bool:
-        user_password_hash = self.get_password_hash(username)
+    async def verify_password(self, username: str, password: str) -> bool:
+        user_password_hash = await self.get_password_hash(username)
         if user_password_hash:
-            return bcrypt.checkpw(password.encode(), user_password_hash.encode())
+            return await password_hasher.verify(username, password, user_password_hash)
         return False
 
-    def get_proxy_for_user(self, username: str) -> Optional[str]:
-        user = self.session.exec(select(User).where(User.username == username)).first()
+    async def get_proxy_for_user(self, username: str) -> Optional[str]:
+        user = await self._get_cached_user(username)
         if user:
             return user.proxy
         return None
+
+    async def find_proxy(self, username: str) -> Optional[str]:
+        """
+        Returns the user's proxy, matching the username case-insensitively,
+        for callers that only have it lowercased (like stored media rows).
+        """
+        statement = (
+            select(User.proxy)
+            .where(func.lower(User.username) == username.lower())
+            .where(User.proxy.is_not(None))
+            .limit(1)
+        )
+        return canonical_proxy((await self.session.exec(statement)).first())
@@ -0,0 +1,37 @@
+import time
+from typing import Dict
+from .config_secrets import Secrets
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SessionValidityCache:
+    """
+    Remembers when each account's Instagram session was last verified, so the
+    get_timeline_feed() health check only runs once per ttl seconds per account.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._verified_at: Dict[str, float] = {}
+        logger.info(f"Initialized SessionValidityCache with ttl={ttl}s")
+
+    def is_valid(self, username: str) -> bool:
+        verified_at = self._verified_at.get(username)
+        if verified_at is None:
+            return False
+        if time.monotonic() - verified_at >= self.ttl:
+            del self._verified_at[username]
+            return False
+        return True
+
+    def mark_valid(self, username: str):
+        self._verified_at[username] = time.monotonic()
+
+    def invalidate(self, username: str):
+        if self._verified_at.pop(username, None) is not None:
+            logger.info(f"Session validity invalidated for user {username}")
+
+
+session_validity = SessionValidityCache(Secrets.SESSION_VALIDITY.SESSION_VALIDITY_TTL)
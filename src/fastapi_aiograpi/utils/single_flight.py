@@ -0,0 +1,119 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+from .config_secrets import Secrets
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent upstream calls.
+
+    The first caller for a key starts the call as a task; callers arriving while
+    it runs await the same task instead of making their own call. Successful
+    results are kept for a per-key TTL so callers right after it also share
+    them. The task is shielded, so a waiting caller disconnecting doesn't
+    cancel the call for the others.
+
+    The call runs on the leader's resources (typically its leased client),
+    which the leader releases once it returns. So when the leader is
+    cancelled, the call is cancelled with it, and the remaining callers start
+    it again with their own fn.
+    """
+
+    def __init__(self, default_ttl: float, max_results: int):
+        self.default_ttl = default_ttl
+        self.max_results = max_results
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._results: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self.calls = 0
+        self.leaders = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+        self.restarts = 0
+        logger.info(
+            f"Initialized SingleFlight (default_ttl={default_ttl}s, max_results={max_results})"
+        )
+
+    async def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Awaitable[Any]],
+        ttl: Optional[float] = None,
+    ) -> Any:
+        self.calls += 1
+        cached = self._results.get(key)
+        if cached is not None:
+            expires_at, result = cached
+            if expires_at > time.monotonic():
+                self.cache_hits += 1
+                return result
+            del self._results[key]
+
+        task = self._in_flight.get(key)
+        leader = task is None
+        if leader:
+            self.leaders += 1
+            task = asyncio.create_task(
+                self._run(key, fn, self.default_ttl if ttl is None else ttl)
+            )
+            # Retrieve the exception even if every caller went away
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._in_flight[key] = task
+        else:
+            self.coalesced += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                # This caller was cancelled
+                if leader and not task.done():
+                    if self._in_flight.get(key) is task:
+                        del self._in_flight[key]
+                    task.cancel()
+                    # Don't let the caller release its resources while the
+                    # call still uses them
+                    await asyncio.wait({task})
+                raise
+            # The leader went away and took the call with it
+            self.restarts += 1
+            return await self.do(key, fn, ttl)
+
+    def forget(self, key: Hashable):
+        self._results.pop(key, None)
+
+    def stats(self) -> dict:
+        shared = self.coalesced + self.cache_hits
+        return {
+            "calls": self.calls,
+            "upstream_calls": self.leaders,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+            "restarts": self.restarts,
+            "hit_rate": shared / self.calls if self.calls else 0.0,
+            "in_flight": len(self._in_flight),
+            "cached_results": len(self._results),
+        }
+
+    async def _run(self, key: Hashable, fn: Callable[[], Awaitable[Any]], ttl: float):
+        try:
+            result = await fn()
+        finally:
+            # A cancelled call may already have been replaced
+            if self._in_flight.get(key) is asyncio.current_task():
+                del self._in_flight[key]
+        if ttl > 0:
+            self._results[key] = (time.monotonic() + ttl, result)
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return result
+
+
+single_flight = SingleFlight(
+    Secrets.SINGLE_FLIGHT.SINGLE_FLIGHT_RESULT_TTL,
+    Secrets.SINGLE_FLIGHT.SINGLE_FLIGHT_MAX_RESULTS,
+)
@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional, Tuple
+from aiograpi import Client
+from sqlmodel.ext.asyncio.session import AsyncSession
+from .config_secrets import Secrets
+from .resilience import call_upstream
+from .single_flight import single_flight
+from ..models.models import UsernamePk
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class UserResolver:
+    """
+    Resolves usernames to Instagram user pks.
+
+    Lookups go through an in-memory LRU first, then the usernamepk table, and only
+    hit Instagram on a miss. Entries older than max_age seconds are refreshed
+    upstream on the next lookup, since usernames can be changed or reclaimed; if
+    that refresh fails the stale pk is still returned.
+    """
+
+    def __init__(self, max_size: int, max_age: float):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._cache: OrderedDict[str, Tuple[int, datetime]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        logger.info(
+            f"Initialized UserResolver (max_size={max_size}, max_age={max_age}s)"
+        )
+
+    async def resolve(
+        self, client: Client, username: str, session: AsyncSession
+    ) -> int:
+        key = username.lower()
+        entry = self._get_cached(key) or await self._load(key, session)
+        if entry and not self._is_stale(entry):
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        try:
+            user_info = await single_flight.do(
+                ("user_info_by_username", key),
+                lambda: call_upstream(
+                    lambda: client.user_info_by_username(username),
+                    username,
+                    client.proxy,
+                ),
+            )
+        except Exception:
+            if entry:
+                logger.warning(f"Refreshing pk for {username} failed, using stale pk")
+                return entry[0]
+            raise
+        await self.remember(username, int(user_info.pk), session)
+        return int(user_info.pk)
+
+    async def cached(self, username: str, session: AsyncSession) -> Optional[int]:
+        """
+        Returns the pk if it is known and fresh, without going upstream.
+        """
+        key = username.lower()
+        entry = self._get_cached(key) or await self._load(key, session)
+        if entry and not self._is_stale(entry):
+            return entry[0]
+        return None
+
+    async def remember(self, username: str, user_pk: int, session: AsyncSession):
+        """
+        Records a username -> pk mapping learned elsewhere (e.g. from a full
+        user_info_by_username call). Writes to the database only when the mapping
+        is new, changed or stale.
+        """
+        key = username.lower()
+        entry = self._get_cached(key)
+        if entry and entry[0] == user_pk and not self._is_stale(entry):
+            return
+
+        updated_at = datetime.now(timezone.utc)
+        await session.merge(
+            UsernamePk(username=key, user_pk=user_pk, updated_at=updated_at)
+        )
+        await session.commit()
+        self._put(key, (user_pk, updated_at))
+
+    def invalidate(self, username: str):
+        self._cache.pop(username.lower(), None)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _get_cached(self, key: str) -> Optional[Tuple[int, datetime]]:
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._cache.move_to_end(key)
+        return entry
+
+    async def _load(
+        self, key: str, session: AsyncSession
+    ) -> Optional[Tuple[int, datetime]]:
+        row = await session.get(UsernamePk, key)
+        if row is None:
+            return None
+        entry = (row.user_pk, row.updated_at)
+        self._put(key, entry)
+        return entry
+
+    def _put(self, key: str, entry: Tuple[int, datetime]):
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def _is_stale(self, entry: Tuple[int, datetime]) -> bool:
+        updated_at = entry[1]
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        age = datetime.now(timezone.utc) - updated_at
+        return age.total_seconds() >= self.max_age
+
+
+user_resolver = UserResolver(
+    Secrets.USER_RESOLVER.USER_RESOLVER_CACHE_SIZE,
+    Secrets.USER_RESOLVER.USER_RESOLVER_MAX_AGE,
+)